@@ -1,12 +1,132 @@
+import os
 import re
 import hashlib
-import random
-from typing import Dict, Any
+from typing import Dict, Any, List
 from datetime import datetime
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+
+from text_scrubber import scrub_pii
+from business_signals import classify_growth, classify_customers
+
+# Lookup tables shared by the per-record and batch paths
+INDUSTRY_MAP = {
+    # Food & Beverage
+    'restaurant': 'food_beverage', 'cafe': 'food_beverage', 'coffee_shop': 'food_beverage',
+    'bar': 'food_beverage', 'food_truck': 'food_beverage', 'hotel': 'food_beverage',
+    
+    # Retail
+    'fashion': 'retail', 'clothing': 'retail', 'boutique': 'retail',
+    'electronics': 'retail', 'supermarket': 'retail', 'shop': 'retail',
+    'store': 'retail', 'wholesale': 'retail',
+    
+    # Services
+    'salon': 'personal_services', 'spa': 'personal_services', 
+    'barbershop': 'personal_services', 'laundry': 'personal_services',
+    'cleaning': 'personal_services', 'beauty': 'personal_services',
+    
+    # Professional Services
+    'consulting': 'professional_services', 'agency': 'professional_services',
+    'freelance': 'professional_services', 'legal': 'professional_services',
+    'accounting': 'professional_services',
+    
+    # Health & Wellness
+    'clinic': 'healthcare', 'pharmacy': 'healthcare', 'fitness': 'healthcare',
+    'gym': 'healthcare', 'wellness': 'healthcare',
+    
+    # Education
+    'school': 'education', 'training': 'education', 'tutoring': 'education',
+    
+    # Default
+    'general': 'general_business'
+}
+
+URBAN_CENTERS = ['nairobi', 'mombasa', 'kisumu', 'nakuru', 'eldoret']
+TOWNS = ['thika', 'naivasha', 'nyeri', 'kakamega', 'kitui', 'machakos', 'meru']
+
+# One scan per location; urban centres are checked before towns
+_URBAN_RE = re.compile('|'.join(URBAN_CENTERS))
+_TOWN_RE = re.compile('|'.join(TOWNS))
+
+# Upper-inclusive band edges: bisect_left(edges, value) is the band index,
+# so a value equal to an edge falls in the lower band (the old `<=` checks)
+REVENUE_BANDS = ([100000, 500000, 1000000, 5000000],
+                 ['under_100k', '100k_500k', '500k_1m', '1m_5m', 'over_5m'])
+CUSTOMER_BANDS = ([100, 1000, 10000],
+                  ['small_base', 'medium_base', 'large_base', 'enterprise_base'])
+AUDIENCE_BANDS = ([1000, 10000, 50000],
+                  ['nascent_audience', 'growing_audience', 'established_audience', 'influencer_audience'])
+BUDGET_BANDS = ([10000, 50000, 200000, 1000000],
+                ['minimal_budget', 'small_budget', 'medium_budget', 'substantial_budget', 'enterprise_budget'])
+# A business is sized by whichever of employees/revenue puts it in the smaller tier
+SIZE_TIERS = ['micro', 'small', 'medium', 'large']
+EMPLOYEE_EDGES = [4, 10, 50]
+SIZE_REVENUE_EDGES = [100000, 500000, 2000000]
+
+MATURITY_EDGES = [1, 3, 7]  # years, lower-inclusive
+MATURITY_TIERS = ['startup', 'growing', 'established', 'mature']
+
+GROWTH_PATTERNS = ['rapid_growth', 'steady_growth', 'stable', 'declining']
+CUSTOMER_PATTERNS = ['high_retention', 'seasonal', 'one_time', 'growing_base']
+
+ANONYMIZED_FIELDS = [
+    'user_id', 'industry', 'size_tier', 'location_tier', 'maturity', 'product_scope',
+    'revenue_band', 'growth_pattern', 'customer_pattern', 'customer_scale',
+    'audience_scale', 'marketing_capacity', 'digital_sophistication'
+]
+
+
+def _band(value, bands, empty=None):
+    """Label for ``value`` in ``bands``; falsy values get ``empty`` (or the lowest band)"""
+    edges, labels = bands
+    if not value:
+        return labels[0] if empty is None else empty
+    return labels[bisect_left(edges, value)]
+
+
+class AnonymousIdService:
+    """
+    Keyed-hash anonymous IDs behind a bounded LRU cache
+    
+    IDs are BLAKE2b keyed with the salt (a MAC, so the salt can't be
+    length-extended or guessed from outputs). The keyed state is built once
+    and copied per ID, and recent IDs are served from the cache, so the
+    request path rarely hashes at all.
+    """
+    
+    def __init__(self, salt: str, cache_size: int = 10000):
+        self._base = hashlib.blake2b(key=salt.encode()[:64], digest_size=8)
+        self._cached = lru_cache(maxsize=cache_size)(self._compute)
+    
+    def _compute(self, user_id: str) -> str:
+        hasher = self._base.copy()
+        hasher.update(user_id.encode())
+        return hasher.hexdigest()
+    
+    def get(self, user_id) -> str:
+        return self._cached(str(user_id))
+    
+    def get_many(self, user_ids) -> List[str]:
+        """Bulk mode for exports: hashes each distinct ID once, skips the LRU"""
+        computed = {}
+        result = []
+        for user_id in user_ids:
+            user_id = str(user_id)
+            anonymous_id = computed.get(user_id)
+            if anonymous_id is None:
+                anonymous_id = computed[user_id] = self._compute(user_id)
+            result.append(anonymous_id)
+        return result
+    
+    def get_stats(self) -> Dict[str, Any]:
+        info = self._cached.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'max_size': info.maxsize}
+
 
 class DataAnonymizer:
     def __init__(self):
         self.salt = hashlib.sha256(b"jengabi_business_salt").hexdigest()
+        self.ids = AnonymousIdService(self.salt, int(os.getenv("ANONYMOUS_ID_CACHE_SIZE", "10000")))
         
     def anonymize_business_data(self, raw_data: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -33,88 +153,98 @@ class DataAnonymizer:
             )
         }
     
+    def anonymize_many(self, records: List[Dict[str, Any]]) -> Dict[str, List[Any]]:
+        """
+        Anonymize many profiles at once (analytics exports, batch jobs)
+        
+        Returns columnar output: {field: [value per record]} with the same
+        fields as anonymize_business_data(). Industry and location lookups
+        are memoized per distinct value and "today" is computed once.
+        """
+        columns = {field: [] for field in ANONYMIZED_FIELDS}
+        industries = {}
+        locations = {}
+        maturities = {}
+        today = datetime.now()
+        
+        columns['user_id'] = self.generate_anonymous_ids([raw_data.get('user_id', '') for raw_data in records])
+        
+        for raw_data in records:
+            business_type = (raw_data.get('business_type') or 'general').lower()
+            industry = industries.get(business_type)
+            if industry is None:
+                industry = industries[business_type] = INDUSTRY_MAP.get(business_type, 'general_business')
+            
+            location = raw_data.get('business_location') or ''
+            location_tier = locations.get(location)
+            if location_tier is None:
+                location_tier = locations[location] = self._categorize_location(location)
+            
+            start_date = raw_data.get('start_date')
+            maturity = maturities.get(start_date)
+            if maturity is None:
+                maturity = maturities[start_date] = self._calculate_business_maturity(start_date, today)
+            
+            columns['industry'].append(industry)
+            columns['size_tier'].append(self._categorize_business_size(raw_data))
+            columns['location_tier'].append(location_tier)
+            columns['maturity'].append(maturity)
+            columns['product_scope'].append(len(raw_data.get('business_products') or []))
+            columns['revenue_band'].append(_band(raw_data.get('monthly_revenue'), REVENUE_BANDS, empty='unknown'))
+            columns['growth_pattern'].append(self._extract_growth_pattern(raw_data))
+            columns['customer_pattern'].append(self._categorize_customer_behavior(raw_data))
+            columns['customer_scale'].append(_band(raw_data.get('customer_count', 0), CUSTOMER_BANDS))
+            columns['audience_scale'].append(_band(raw_data.get('social_media_followers', 0), AUDIENCE_BANDS))
+            columns['marketing_capacity'].append(_band(raw_data.get('marketing_budget', 0), BUDGET_BANDS))
+            columns['digital_sophistication'].append(self._assess_digital_sophistication(
+                raw_data.get('has_website', False),
+                raw_data.get('social_media_profiles', {})
+            ))
+        
+        return columns
+    
+    @staticmethod
+    def rows(columns: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+        """Turn anonymize_many() output back into one dict per record"""
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
+    
     def _generate_anonymous_id(self, user_id: str) -> str:
         """Generate anonymous user ID"""
-        return hashlib.sha256(f"{user_id}{self.salt}".encode()).hexdigest()[:16]
+        return self.ids.get(user_id)
+    
+    def generate_anonymous_ids(self, user_ids: List[str]) -> List[str]:
+        """Anonymous IDs for many users (batch exports)"""
+        return self.ids.get_many(user_ids)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {'id_cache': self.ids.get_stats()}
     
     def _categorize_industry(self, business_type: str) -> str:
         """Categorize business into industry groups"""
-        industry_map = {
-            # Food & Beverage
-            'restaurant': 'food_beverage', 'cafe': 'food_beverage', 'coffee_shop': 'food_beverage',
-            'bar': 'food_beverage', 'food_truck': 'food_beverage', 'hotel': 'food_beverage',
-            
-            # Retail
-            'fashion': 'retail', 'clothing': 'retail', 'boutique': 'retail',
-            'electronics': 'retail', 'supermarket': 'retail', 'shop': 'retail',
-            'store': 'retail', 'wholesale': 'retail',
-            
-            # Services
-            'salon': 'personal_services', 'spa': 'personal_services', 
-            'barbershop': 'personal_services', 'laundry': 'personal_services',
-            'cleaning': 'personal_services', 'beauty': 'personal_services',
-            
-            # Professional Services
-            'consulting': 'professional_services', 'agency': 'professional_services',
-            'freelance': 'professional_services', 'legal': 'professional_services',
-            'accounting': 'professional_services',
-            
-            # Health & Wellness
-            'clinic': 'healthcare', 'pharmacy': 'healthcare', 'fitness': 'healthcare',
-            'gym': 'healthcare', 'wellness': 'healthcare',
-            
-            # Education
-            'school': 'education', 'training': 'education', 'tutoring': 'education',
-            
-            # Default
-            'general': 'general_business'
-        }
-        return industry_map.get(business_type.lower(), 'general_business')
+        return INDUSTRY_MAP.get(business_type.lower(), 'general_business')
     
     def _categorize_business_size(self, data: Dict) -> str:
         """Categorize business by size"""
-        employee_count = data.get('employee_count', 0)
-        revenue = data.get('monthly_revenue', 0)
-        
-        if employee_count <= 4 or revenue <= 100000:
-            return 'micro'
-        elif employee_count <= 10 or revenue <= 500000:
-            return 'small'
-        elif employee_count <= 50 or revenue <= 2000000:
-            return 'medium'
-        else:
-            return 'large'
+        employee_count = data.get('employee_count') or 0
+        revenue = data.get('monthly_revenue') or 0
+        return SIZE_TIERS[min(bisect_left(EMPLOYEE_EDGES, employee_count),
+                              bisect_left(SIZE_REVENUE_EDGES, revenue))]
     
     def _categorize_location(self, location: str) -> str:
         """Categorize location into tiers"""
         location_lower = location.lower() if location else ''
-        
-        urban_centers = ['nairobi', 'mombasa', 'kisumu', 'nakuru', 'eldoret']
-        towns = ['thika', 'naivasha', 'nyeri', 'kakamega', 'kitui', 'machakos', 'meru']
-        
-        if any(center in location_lower for center in urban_centers):
+        if _URBAN_RE.search(location_lower):
             return 'urban_center'
-        elif any(town in location_lower for town in towns):
+        elif _TOWN_RE.search(location_lower):
             return 'town'
         else:
             return 'rural'
     
     def _categorize_revenue(self, revenue: float) -> str:
         """Categorize revenue into bands"""
-        if not revenue:
-            return 'unknown'
-        elif revenue <= 100000:
-            return 'under_100k'
-        elif revenue <= 500000:
-            return '100k_500k'
-        elif revenue <= 1000000:
-            return '500k_1m'
-        elif revenue <= 5000000:
-            return '1m_5m'
-        else:
-            return 'over_5m'
+        return _band(revenue, REVENUE_BANDS, empty='unknown')
     
-    def _calculate_business_maturity(self, start_date: str) -> str:
+    def _calculate_business_maturity(self, start_date: str, today: datetime = None) -> str:
         """Categorize business maturity based on age"""
         # If no start_date, return default
         if not start_date:
@@ -123,69 +253,38 @@ class DataAnonymizer:
         try:
             # Calculate business age from start_date
             start = datetime.strptime(start_date, '%Y-%m-%d')
-            today = datetime.now()
+            today = today or datetime.now()
             business_age_days = (today - start).days
             business_age_years = business_age_days / 365.25
             
-            if business_age_years < 1:
-                return 'startup'
-            elif business_age_years < 3:
-                return 'growing'
-            elif business_age_years < 7:
-                return 'established'
-            else:
-                return 'mature'
+            # bisect_right: an age equal to an edge belongs to the older tier
+            return MATURITY_TIERS[bisect_right(MATURITY_EDGES, business_age_years)]
         except:
             return 'established'  # Fallback
     
     def _extract_growth_pattern(self, data: Dict) -> str:
-        """Extract growth pattern from available data"""
-        # Placeholder - in production, analyze historical data
-        patterns = ['rapid_growth', 'steady_growth', 'stable', 'declining']
-        return random.choice(patterns)  # For demo - replace with real analysis
+        """Growth pattern kept on the profile by the signal aggregator (business_signals.py)"""
+        pattern = data.get('growth_pattern')
+        return pattern if pattern in GROWTH_PATTERNS else classify_growth(data.get('signals'))
     
     def _categorize_customer_behavior(self, data: Dict) -> str:
-        """Categorize customer behavior patterns"""
-        # Placeholder - in production, analyze customer data
-        patterns = ['high_retention', 'seasonal', 'one_time', 'growing_base']
-        return random.choice(patterns)
+        """Customer pattern kept on the profile by the signal aggregator (business_signals.py)"""
+        pattern = data.get('customer_pattern')
+        return pattern if pattern in CUSTOMER_PATTERNS else classify_customers(data.get('signals'))
     
     # ✅ NEW METHODS ADDED:
     
     def _categorize_customer_size(self, customer_count: int) -> str:
         """Categorize business by customer base size"""
-        if not customer_count or customer_count <= 100:
-            return 'small_base'
-        elif customer_count <= 1000:
-            return 'medium_base'
-        elif customer_count <= 10000:
-            return 'large_base'
-        else:
-            return 'enterprise_base'
+        return _band(customer_count, CUSTOMER_BANDS)
     
     def _categorize_audience_size(self, followers: int) -> str:
         """Categorize social media audience size"""
-        if not followers or followers <= 1000:
-            return 'nascent_audience'
-        elif followers <= 10000:
-            return 'growing_audience'
-        elif followers <= 50000:
-            return 'established_audience'
-        else:
-            return 'influencer_audience'
+        return _band(followers, AUDIENCE_BANDS)
     
     def _categorize_marketing_budget(self, budget: float) -> str:
         """Categorize marketing budget into tiers"""
-        if not budget or budget <= 10000:
-            return 'minimal_budget'
-        elif budget <= 50000:
-            return 'small_budget'
-        elif budget <= 200000:
-            return 'medium_budget'
-        elif budget <= 1000000:
-            return 'substantial_budget'
-        else:
-            return 'enterprise_budget'
+        return _band(budget, BUDGET_BANDS)
     
     def _assess_digital_sophistication(self, has_website: bool, social_media_presence: dict) -> str:
         """Assess digital maturity of business"""
@@ -200,39 +299,8 @@ class DataAnonymizer:
             return 'digitally_nascent'
     
     def remove_sensitive_terms(self, text: str) -> str:
-        """Remove PII and sensitive terms from text"""
-        if not text:
-            return ""
-            
-        # Remove phone numbers
-        text = re.sub(r'\+\d{1,3}[-.\s]?\d{1,14}', '[PHONE]', text)
-        text = re.sub(r'\d{10,}', '[NUMBER]', text)
-        
-        # Remove specific location references
-        specific_locations = [
-            'nairobi cbd', 'westlands', 'karen', 'mombasa road', 'thika road',
-            'langata', 'kileleshwa', 'lavington', 'kilimani', 'parklands',
-            'industrial area', 'upper hill', 'nyayo estate'
-        ]
-        for location in specific_locations:
-            text = text.replace(location, '[LOCATION]')
-        
-        # Remove exact monetary amounts
-        text = re.sub(r'KES\s?\d{1,3}(?:,\d{3})*(?:\.\d{2})?', '[AMOUNT]', text)
-        text = re.sub(r'\d{1,3}(?:,\d{3})*\s?(?:shillings|bob)', '[AMOUNT]', text)
-        text = re.sub(r'\$\s?\d{1,3}(?:,\d{3})*(?:\.\d{2})?', '[AMOUNT]', text)
-        
-        # Remove names (simple pattern)
-        text = re.sub(r'\b[A-Z][a-z]+ [A-Z][a-z]+\b', '[NAME]', text)
-        
-        # Remove email addresses
-        text = re.sub(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', '[EMAIL]', text)
-        
-        # Remove specific business names (common Kenyan business patterns)
-        business_indicators = ['ltd', 'limited', 'company', 'enterprises', 'ventures']
-        text = re.sub(r'\b[\w\s]+(?:' + '|'.join(business_indicators) + r')\b', '[BUSINESS]', text, flags=re.IGNORECASE)
-        
-        return text.strip()
+        """Remove PII and sensitive terms from text (single precompiled scan)"""
+        return scrub_pii(text)
     
     def get_anonymized_business_description(self, anonymized_data: Dict[str, Any]) -> str:
         """Generate a safe business description from anonymized data"""
@@ -0,0 +1,135 @@
+"""
+Structured, non-blocking logging
+
+Records go onto an in-memory queue and a background listener writes them to
+stdout, so request threads never block on console I/O. Output is one JSON
+object per line (or plain text with LOG_FORMAT=text); fields passed as
+``extra={'fields': {...}}`` become top-level keys, which keeps production
+logs searchable.
+
+Debug records are sampled before they are formatted, so verbose debug
+calls with lazy %-style arguments cost almost nothing when dropped. If the
+queue is full, records are dropped and counted rather than blocking.
+
+Modules log through get_logger(__name__) with lazy %-style arguments, so a
+message below the configured level is never formatted.
+
+Settings (env):
+    LOG_LEVEL              minimum level (default INFO)
+    LOG_FORMAT             json or text (default json)
+    LOG_DEBUG_SAMPLE_RATE  fraction of debug records kept (default 0.01)
+    LOG_QUEUE_SIZE         records buffered before dropping (default 10000)
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+_ROOT = 'jengabi'
+_setup_lock = threading.Lock()
+_listener = None
+_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+            'thread': record.threadName
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, 'fields', None)
+        return f"{text} {json.dumps(fields, default=str, ensure_ascii=False)}" if fields else text
+
+
+class DebugSampler(logging.Filter):
+    """Keep every non-debug record and a random fraction of debug ones"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or random.random() < self.rate:
+            return True
+        self.dropped += 1
+        return False
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """QueueHandler that drops (and counts) records when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging():
+    """Configure the queue handler and stdout listener once per process"""
+    global _listener, _handler
+    with _setup_lock:
+        if _handler is not None:
+            return
+        level = getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO)
+        sample_rate = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(TextFormatter() if os.getenv("LOG_FORMAT", "json") == "text" else JsonFormatter())
+
+        _handler = NonBlockingQueueHandler(queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", "10000"))))
+        _handler.addFilter(DebugSampler(sample_rate))
+
+        root = logging.getLogger(_ROOT)
+        root.setLevel(level)
+        root.addHandler(_handler)
+        root.propagate = False
+
+        _listener = QueueListener(_handler.queue, output, respect_handler_level=True)
+        _listener.start()
+        # Flush what's queued on shutdown
+        atexit.register(_listener.stop)
+
+
+def get_logger(name=None):
+    setup_logging()
+    return logging.getLogger(f"{_ROOT}.{name}" if name else _ROOT)
+
+
+def get_stats():
+    sampler = next((f for f in (_handler.filters if _handler else []) if isinstance(f, DebugSampler)), None)
+    return {
+        'level': logging.getLevelName(logging.getLogger(_ROOT).level),
+        'queued': _handler.queue.qsize() if _handler else 0,
+        'dropped_queue_full': _handler.dropped if _handler else 0,
+        'debug_sampled_out': sampler.dropped if sampler else 0
+    }
@@ -0,0 +1,362 @@
+"""
+Deterministic growth and customer-pattern classification
+
+Each profile keeps a rolling window of weekly activity in profile_signals
+(signals_schema.sql):
+
+    activity   messages + feature uses per week, oldest first
+    payments   successful M-Pesa payments per week
+
+SignalAggregator folds new rows from feature_usage, mpesa_transactions and
+message_events (message usage buffered in process by record_messages() and
+inserted in batches, off the request path) into those windows at the time each event happened. Every source is read
+past a stored created_at watermark minus a lookback, so rows that commit
+after later ones are still picked up; ids already folded inside the lookback
+are kept with the watermark and skipped. Only the profiles with new events,
+and once a week the ones whose window has to roll over, are loaded,
+reclassified and written back (growth_pattern / customer_pattern onto
+profiles). The classifiers are pure functions of the window, so equal
+business states always give equal anonymized profiles (and share prompt
+cache entries).
+
+It runs as a cluster scheduler job, so only one process folds events at a
+time.
+
+Settings (env):
+    SIGNALS_INTERVAL_SECONDS  how often the aggregator runs (default 21600)
+    SIGNALS_LOOKBACK_SECONDS  how far behind the watermark to re-read (default 900)
+    SIGNALS_FLUSH_SECONDS     how often buffered message counts are inserted (default 5)
+"""
+
+import os
+import time
+import atexit
+import threading
+from datetime import datetime, timedelta, timezone
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+WINDOW_WEEKS = 8
+# A payment says more about a business's momentum than a chat message
+PAYMENT_WEIGHT = 5
+
+GROWTH_NO_DATA = 'stable'
+CUSTOMER_NO_DATA = 'growing_base'
+
+
+def week_start(moment):
+    """Monday (UTC date) of the week containing ``moment``"""
+    day = moment.astimezone(timezone.utc).date() if moment.tzinfo else moment.date()
+    return day - timedelta(days=day.weekday())
+
+
+def _parse_timestamp(value):
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def empty_state(profile_id, week):
+    return {
+        'profile_id': profile_id,
+        'week_start': week.isoformat(),
+        'activity': [0] * WINDOW_WEEKS,
+        'payments': [0] * WINDOW_WEEKS,
+        'observed_weeks': 0,
+        'growth_pattern': GROWTH_NO_DATA,
+        'customer_pattern': CUSTOMER_NO_DATA
+    }
+
+
+def advance(state, week):
+    """Shift the window so its last bucket is ``week``"""
+    current = datetime.strptime(state['week_start'], '%Y-%m-%d').date()
+    shift = (week - current).days // 7
+    if shift <= 0:
+        return
+    for field in ('activity', 'payments'):
+        state[field] = (state[field] + [0] * min(shift, WINDOW_WEEKS))[-WINDOW_WEEKS:]
+    if state['observed_weeks']:
+        state['observed_weeks'] += shift
+    state['week_start'] = week.isoformat()
+
+
+def add_event(state, when, field, count=1):
+    """Count ``count`` events at ``when`` into the bucket they belong to"""
+    current = datetime.strptime(state['week_start'], '%Y-%m-%d').date()
+    index = WINDOW_WEEKS - 1 - (current - week_start(when)).days // 7
+    if 0 <= index < WINDOW_WEEKS:
+        state[field][index] += count
+        if not state['observed_weeks']:
+            state['observed_weeks'] = 1
+
+
+def _weighted(state):
+    return [a + PAYMENT_WEIGHT * p for a, p in zip(state['activity'], state['payments'])]
+
+
+def classify_growth(state):
+    """rapid_growth / steady_growth / stable / declining from the last 4 weeks vs the 4 before"""
+    if not state:
+        return GROWTH_NO_DATA
+    weekly = _weighted(state)
+    half = WINDOW_WEEKS // 2
+    prior, recent = sum(weekly[:half]), sum(weekly[half:])
+    if not prior:
+        return 'rapid_growth' if recent else GROWTH_NO_DATA
+    ratio = recent / prior
+    if ratio >= 1.5:
+        return 'rapid_growth'
+    if ratio >= 1.1:
+        return 'steady_growth'
+    if ratio >= 0.8:
+        return 'stable'
+    return 'declining'
+
+
+def classify_customers(state):
+    """high_retention / growing_base / seasonal / one_time from how regularly the business is active"""
+    if not state:
+        return CUSTOMER_NO_DATA
+    weekly = _weighted(state)
+    half = WINDOW_WEEKS // 2
+    active_weeks = sum(1 for value in weekly if value)
+    if active_weeks >= WINDOW_WEEKS - 2:
+        return 'high_retention'
+    if active_weeks <= 1:
+        # Too new to judge vs. came once and left
+        return CUSTOMER_NO_DATA if state['observed_weeks'] < half else 'one_time'
+    if sum(1 for value in weekly[half:] if value) > sum(1 for value in weekly[:half] if value):
+        return 'growing_base'
+    return 'seasonal'
+
+
+class SignalAggregator:
+    """Incrementally folds usage, payment and message activity into profile_signals"""
+
+    SOURCES = {
+        # source table -> (columns, filter, state field, count column)
+        'feature_usage': ('id, profile_id, created_at', None, 'activity', None),
+        'mpesa_transactions': ('id, profile_id, created_at', ('result_code', 0), 'payments', None),
+        'message_events': ('id, profile_id, created_at, message_count', None, 'activity', 'message_count'),
+    }
+
+    def __init__(self, client, page_size=1000, chunk_size=200, on_update=None, lookback_seconds=None,
+                 flush_interval=None):
+        self.client = client
+        self.page_size = page_size
+        self.chunk_size = chunk_size
+        self.on_update = on_update
+        if lookback_seconds is None:
+            lookback_seconds = int(os.getenv("SIGNALS_LOOKBACK_SECONDS", "900"))
+        self.lookback = timedelta(seconds=lookback_seconds)
+        if flush_interval is None:
+            flush_interval = float(os.getenv("SIGNALS_FLUSH_SECONDS", "5"))
+        self.flush_interval = flush_interval
+        self.stats = {'runs': 0, 'events': 0, 'messages_recorded': 0, 'message_flush_failures': 0,
+                      'profiles_updated': 0, 'patterns_changed': 0, 'last_run': None, 'last_duration': None}
+        self._message_counts = {}
+        self._message_lock = threading.Lock()
+        self._flush_failing = False
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True, name="message-events")
+        self._flusher.start()
+        atexit.register(self.flush_messages)
+
+    def record_messages(self, counts):
+        """Buffer message usage ({profile_id: count}); the flush thread inserts it into message_events"""
+        with self._message_lock:
+            for profile_id, count in counts.items():
+                if count:
+                    self._message_counts[profile_id] = self._message_counts.get(profile_id, 0) + count
+
+    def flush_messages(self):
+        """Insert the buffered counts as one batch (dropped on failure - they only feed the signals)"""
+        with self._message_lock:
+            counts, self._message_counts = self._message_counts, {}
+        if not counts:
+            return
+        rows = [{'profile_id': profile_id, 'message_count': count} for profile_id, count in counts.items()]
+        try:
+            for i in range(0, len(rows), self.chunk_size):
+                self.client.table('message_events').insert(rows[i:i + self.chunk_size]).execute()
+            self.stats['messages_recorded'] += len(rows)
+            self._flush_failing = False
+        except Exception as e:
+            self.stats['message_flush_failures'] += 1
+            # Once per outage (e.g. signals_schema.sql not run yet), not once per flush
+            if not self._flush_failing:
+                logger.warning("⚠️ Could not record message events: %s", e)
+            self._flush_failing = True
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush_messages()
+
+    def stop(self):
+        self._stop.set()
+        self.flush_messages()
+
+    def _pages(self, query_builder):
+        """Yield rows page by page (query_builder() returns a fresh ordered query)"""
+        offset = 0
+        while True:
+            rows = query_builder().range(offset, offset + self.page_size - 1).execute().data or []
+            yield from rows
+            if len(rows) < self.page_size:
+                return
+            offset += self.page_size
+
+    def _load_watermarks(self):
+        rows = self.client.table('signal_watermarks').select('source, last_seen, recent_ids').execute().data or []
+        return {row['source']: row for row in rows}
+
+    def _read_events(self, now):
+        """New rows from every source as {profile_id: [(when, field, count)]}, plus the watermarks to store"""
+        watermarks = self._load_watermarks()
+        events = {}
+        new_watermarks = []
+        for source, (columns, condition, field, count_column) in self.SOURCES.items():
+            mark = watermarks.get(source) or {}
+            last_seen = (_parse_timestamp(mark['last_seen']) if mark.get('last_seen')
+                         else now - timedelta(weeks=WINDOW_WEEKS))
+            # id -> created_at of rows already folded inside the lookback
+            recent = dict(mark.get('recent_ids') or {})
+            since = (last_seen - self.lookback).isoformat()
+
+            def query(source=source, columns=columns, condition=condition, since=since):
+                q = self.client.table(source).select(columns).gt('created_at', since)
+                if condition:
+                    q = q.eq(*condition)
+                return q.order('created_at').order('id')
+
+            seen = 0
+            for row in self._pages(query):
+                key = str(row['id'])
+                if key in recent or not row.get('created_at'):
+                    continue
+                when = _parse_timestamp(row['created_at'])
+                recent[key] = row['created_at']
+                last_seen = max(last_seen, when)
+                seen += 1
+                if row.get('profile_id'):
+                    count = (row.get(count_column) or 0) if count_column else 1
+                    events.setdefault(row['profile_id'], []).append((when, field, count))
+
+            if seen:
+                cutoff = last_seen - self.lookback
+                new_watermarks.append({
+                    'source': source,
+                    'last_seen': last_seen.isoformat(),
+                    'recent_ids': {key: created for key, created in recent.items()
+                                   if _parse_timestamp(created) > cutoff}
+                })
+        return events, new_watermarks
+
+    @staticmethod
+    def _fingerprint(state):
+        return (tuple(state['activity']), tuple(state['payments']), state['observed_weeks'],
+                state['week_start'], state.get('growth_pattern'), state.get('customer_pattern'))
+
+    @classmethod
+    def _prepare(cls, row, week):
+        """Normalize a stored row and roll it forward to ``week``; returns (state, saved fingerprint)"""
+        row['activity'] = list(row.get('activity') or [0] * WINDOW_WEEKS)
+        row['payments'] = list(row.get('payments') or [0] * WINDOW_WEEKS)
+        row['observed_weeks'] = row.get('observed_weeks') or 0
+        row['week_start'] = str(row['week_start'])[:10]
+        saved = cls._fingerprint(row)
+        advance(row, week)
+        return row, saved
+
+    def _save(self, prepared, now, reclassified):
+        """Reclassify, then upsert only the states that changed; returns how many were written"""
+        changed_rows = []
+        for state, saved in prepared:
+            growth, customers = classify_growth(state), classify_customers(state)
+            if (growth, customers) != (state['growth_pattern'], state['customer_pattern']):
+                reclassified.setdefault((growth, customers), []).append(state['profile_id'])
+                state['growth_pattern'], state['customer_pattern'] = growth, customers
+            if self._fingerprint(state) != saved:
+                state['updated_at'] = now.isoformat()
+                changed_rows.append(state)
+
+        for i in range(0, len(changed_rows), self.chunk_size):
+            self.client.table('profile_signals').upsert(changed_rows[i:i + self.chunk_size]).execute()
+        return len(changed_rows)
+
+    def run(self):
+        started = time.time()
+        # This process's buffered messages go in before the read
+        self.flush_messages()
+        now = datetime.now(timezone.utc)
+        week = week_start(now)
+
+        events, new_watermarks = self._read_events(now)
+        reclassified = {}
+        saved_count = 0
+
+        # Profiles with new events
+        profile_ids = list(events)
+        for i in range(0, len(profile_ids), self.chunk_size):
+            chunk = profile_ids[i:i + self.chunk_size]
+            rows = self.client.table('profile_signals').select('*').in_('profile_id', chunk).execute().data or []
+            stored = {row['profile_id']: row for row in rows}
+            prepared = []
+            for profile_id in chunk:
+                if profile_id in stored:
+                    state, saved = self._prepare(stored[profile_id], week)
+                else:
+                    state, saved = empty_state(profile_id, week), None
+                for when, field, count in events[profile_id]:
+                    add_event(state, when, field, count)
+                prepared.append((state, saved))
+            saved_count += self._save(prepared, now, reclassified)
+
+        # Quiet profiles still need their window rolled over once a week.
+        # Keyset paging, since saving moves rows out of the filter.
+        last_id = None
+        while True:
+            query = self.client.table('profile_signals').select('*').lt('week_start', week.isoformat())
+            if last_id is not None:
+                query = query.gt('profile_id', last_id)
+            rows = query.order('profile_id').limit(self.page_size).execute().data or []
+            if not rows:
+                break
+            saved_count += self._save([self._prepare(row, week) for row in rows], now, reclassified)
+            last_id = rows[-1]['profile_id']
+            if len(rows) < self.page_size:
+                break
+
+        # One set-based update per (growth, customer) pair
+        updated_ids = []
+        for (growth, customers), ids in reclassified.items():
+            for i in range(0, len(ids), self.chunk_size):
+                chunk = ids[i:i + self.chunk_size]
+                self.client.table('profiles').update({
+                    'growth_pattern': growth,
+                    'customer_pattern': customers
+                }).in_('id', chunk).execute()
+                updated_ids.extend(chunk)
+
+        # Only advance the watermarks once the folded counts are saved
+        if new_watermarks:
+            self.client.table('signal_watermarks').upsert(new_watermarks).execute()
+
+        if self.on_update and updated_ids:
+            self.on_update(updated_ids)
+
+        event_count = sum(len(profile_events) for profile_events in events.values())
+        duration = time.time() - started
+        self.stats['runs'] += 1
+        self.stats['events'] += event_count
+        self.stats['profiles_updated'] += saved_count
+        self.stats['patterns_changed'] += len(updated_ids)
+        self.stats['last_run'] = now.isoformat()
+        self.stats['last_duration'] = round(duration, 2)
+        logger.info("✅ Profile signals: %s events for %s profiles, %s profiles saved, %s reclassified in %.1fs", event_count, len(events), saved_count, len(updated_ids), duration)
+
+    def get_stats(self):
+        return dict(self.stats)
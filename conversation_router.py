@@ -0,0 +1,166 @@
+"""
+Declarative conversation routing shared by the Telegram and WhatsApp channels
+
+Each channel declares its routes once, in priority order. A route matches
+on any of:
+
+    commands  normalized message text (stripped, lowercased) it answers to
+    state     session key that must be truthy (awaiting_qstn, onboarding, ...)
+    when      extra predicate for rules that can't be keyed (substring
+              matches, M-Pesa flow steps, profile checks)
+
+At compile time every command gets the precomputed list of routes that can
+apply to it (its own routes plus the command-agnostic ones, in priority
+order), so a dispatch is one dict lookup followed by cheap session checks,
+and the message is normalized exactly once. A handler returns the reply, or
+None to let the next route try (used for side-effect rules such as clearing
+stale state).
+
+Per-route call counts and handler time, plus the router's own overhead,
+are kept for /api/health. check() asserts which routes a table of sample
+turns reaches, so a reordered route table can be verified without a chat.
+"""
+
+import time
+import threading
+
+
+class Turn:
+    """One inbound message with everything the handlers need"""
+
+    __slots__ = ('channel', 'phone_number', 'user_profile', 'session', 'text', 'body', 'key',
+                 'is_slash', 'command', 'extra')
+
+    def __init__(self, channel, phone_number, user_profile, session, text, extra=None):
+        self.channel = channel
+        self.phone_number = phone_number
+        self.user_profile = user_profile
+        self.session = session
+        # Text as the channel received it; body is it stripped, key the normalized form
+        self.text = text or ''
+        self.body = self.text.strip()
+        self.key = self.body.lower()
+        self.is_slash = self.text.startswith('/')
+        self.command = self.key[1:].strip() if self.is_slash else self.key
+        self.extra = extra
+
+
+class Route:
+    __slots__ = ('name', 'handler', 'commands', 'state', 'when')
+
+    def __init__(self, name, handler, commands=None, state=None, when=None):
+        self.name = name
+        self.handler = handler
+        self.commands = frozenset(commands) if commands else None
+        self.state = state
+        self.when = when
+
+
+class ConversationRouter:
+    """Ordered routes with O(1) candidate lookup by normalized command"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self._routes = []
+        self._by_command = {}
+        self._generic = ()
+        self._compiled = False
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._overhead = 0.0
+        self._dispatches = 0
+
+    def route(self, name, handler, commands=None, state=None, when=None):
+        """Register a route; registration order is priority order"""
+        self._routes.append(Route(name, handler, commands, state, when))
+        self._metrics[name] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+        self._compiled = False
+        return handler
+
+    def compile(self):
+        generic = tuple(r for r in self._routes if r.commands is None)
+        commands = set()
+        for r in self._routes:
+            commands.update(r.commands or ())
+        self._by_command = {
+            command: tuple(r for r in self._routes if r.commands is None or command in r.commands)
+            for command in commands
+        }
+        self._generic = generic
+        self._compiled = True
+
+    def _candidates(self, turn):
+        """Routes whose command, state and predicate match ``turn``, in priority order"""
+        session = turn.session
+        for r in self._by_command.get(turn.key, self._generic):
+            if r.state is not None and not session.get(r.state):
+                continue
+            if r.when is not None and not r.when(turn):
+                continue
+            yield r
+
+    def dispatch(self, turn):
+        """Return the first non-None reply, or None if no route answered"""
+        if not self._compiled:
+            self.compile()
+        started = time.perf_counter()
+        handler_seconds = 0.0
+        try:
+            for r in self._candidates(turn):
+                handler_started = time.perf_counter()
+                try:
+                    reply = r.handler(turn)
+                finally:
+                    elapsed = time.perf_counter() - handler_started
+                    handler_seconds += elapsed
+                    self._record(r.name, elapsed)
+                if reply is not None:
+                    return reply
+            return None
+        finally:
+            with self._lock:
+                self._dispatches += 1
+                self._overhead += time.perf_counter() - started - handler_seconds
+
+    def trace(self, turn, live=()):
+        """Names of the routes a dispatch of ``turn`` reaches, ending with the one that answers.
+
+        Handlers are not called, except those of the routes named in ``live``:
+        they run for real and pass the turn on when they return None.
+        """
+        if not self._compiled:
+            self.compile()
+        reached = []
+        for r in self._candidates(turn):
+            reached.append(r.name)
+            if r.name not in live or r.handler(turn) is not None:
+                break
+        return reached
+
+    def check(self, cases):
+        """Assert the trace of every (label, turn, expected route names, live routes) case"""
+        for label, turn, expected, live in cases:
+            reached = self.trace(turn, live)
+            assert reached == list(expected), f"{self.channel} / {label}: expected {list(expected)}, got {reached}"
+        return len(cases)
+
+    def _record(self, name, elapsed):
+        with self._lock:
+            metric = self._metrics[name]
+            metric['calls'] += 1
+            metric['seconds'] += elapsed
+            if elapsed > metric['max_seconds']:
+                metric['max_seconds'] = elapsed
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'dispatches': self._dispatches,
+                'overhead_us_avg': round(self._overhead / self._dispatches * 1e6, 1) if self._dispatches else 0.0,
+                'routes': {
+                    name: {'calls': m['calls'],
+                           'avg_ms': round(m['seconds'] / m['calls'] * 1000, 2) if m['calls'] else 0.0,
+                           'max_ms': round(m['max_seconds'] * 1000, 2)}
+                    for name, m in self._metrics.items() if m['calls']
+                }
+            }
@@ -0,0 +1,128 @@
+import os
+import copy
+import time
+import threading
+from datetime import datetime, timezone
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+def parse_end_date(end_date_str):
+    """Parse a subscriptions.end_date value (ISO string, optional 'Z')"""
+    if not end_date_str:
+        return None
+    try:
+        return datetime.fromisoformat(str(end_date_str).replace('Z', '+00:00'))
+    except (ValueError, TypeError) as e:
+        logger.error("Error parsing end_date: %s", e)
+        return None
+
+
+def is_end_date_passed(end_date, now=None):
+    """Compare against now() with matching timezone awareness"""
+    if end_date is None:
+        return False
+    if now is None:
+        now = datetime.now(timezone.utc) if end_date.tzinfo is not None else datetime.now()
+    return now > end_date
+
+
+class EntitlementCache:
+    """Per-profile cache of plan type, end_date, output_type and credits.
+
+    Expiry is evaluated locally from the cached end_date, so a permission
+    check costs no round-trip until the entry is invalidated. Writers
+    (payment activation, expiry cleanup, credit resets) call invalidate();
+    the TTL only bounds staleness for writes made by other workers.
+
+    "No subscription" is kept for negative_ttl_seconds only: a payment
+    activated on another worker has to show up here within seconds.
+    """
+
+    def __init__(self, ttl_seconds=300, negative_ttl_seconds=5):
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self._subscriptions = {}
+        self._credits = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def _lookup(self, table, profile_id):
+        with self._lock:
+            entry = table.get(profile_id)
+            if entry and time.time() - entry['stored_at'] <= entry['ttl']:
+                self.stats['hits'] += 1
+                return entry
+        self.stats['misses'] += 1
+        return None
+
+    def get_subscription(self, profile_id, loader):
+        """Return the active subscription row (or None), calling ``loader()`` on a miss.
+
+        Returns a (subscription, end_date) tuple; end_date is pre-parsed.
+        """
+        entry = self._lookup(self._subscriptions, profile_id)
+        if entry is None:
+            subscription = loader()
+            entry = {
+                'subscription': subscription,
+                'end_date': parse_end_date(subscription.get('end_date')) if subscription else None,
+                'stored_at': time.time(),
+                'ttl': self.ttl_seconds if subscription else self.negative_ttl_seconds
+            }
+            if entry['ttl'] > 0:
+                with self._lock:
+                    self._subscriptions[profile_id] = entry
+        return copy.deepcopy(entry['subscription']), entry['end_date']
+
+    def get_credits(self, profile_id, loader):
+        """Return the user_credits row, calling ``loader()`` on a miss"""
+        entry = self._lookup(self._credits, profile_id)
+        if entry is None:
+            credits = loader()
+            entry = {'credits': credits, 'stored_at': time.time(), 'ttl': self.ttl_seconds}
+            if credits is not None:
+                with self._lock:
+                    self._credits[profile_id] = entry
+        return copy.deepcopy(entry['credits'])
+
+    def invalidate(self, profile_id):
+        """Forget subscription and credits for one profile"""
+        self.stats['invalidations'] += 1
+        with self._lock:
+            self._subscriptions.pop(profile_id, None)
+            self._credits.pop(profile_id, None)
+
+    def invalidate_credits(self, profile_id=None):
+        """Forget cached credits for one profile, or for everyone"""
+        self.stats['invalidations'] += 1
+        with self._lock:
+            if profile_id is None:
+                self._credits.clear()
+            else:
+                self._credits.pop(profile_id, None)
+
+    def clear(self):
+        """Forget everything - used after bulk subscription changes"""
+        self.stats['invalidations'] += 1
+        with self._lock:
+            self._subscriptions.clear()
+            self._credits.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                **self.stats,
+                'subscriptions': len(self._subscriptions),
+                'credits': len(self._credits),
+                'ttl_seconds': self.ttl_seconds,
+                'negative_ttl_seconds': self.negative_ttl_seconds
+            }
+
+
+# Global instance
+entitlement_cache = EntitlementCache(
+    ttl_seconds=int(os.getenv("ENTITLEMENT_CACHE_TTL", "300")),
+    negative_ttl_seconds=int(os.getenv("ENTITLEMENT_NEGATIVE_TTL", "5"))
+)
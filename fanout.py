@@ -0,0 +1,73 @@
+"""
+Concurrent fan-out with per-source deadlines
+
+gather() runs independent fetches at the same time on a shared pool and
+waits for each one only until its own deadline. A source that fails or is
+too slow is replaced by its fallback, so the caller's latency is bounded by
+the slowest deadline instead of the sum of every fetch.
+
+Threads can't be cancelled, so a source that misses its deadline keeps
+running in the background and its result is discarded; give blocking
+clients their own socket timeouts as well.
+
+Settings (env):
+    FANOUT_WORKERS  shared pool size (default 16)
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+fanout_pool = ThreadPoolExecutor(max_workers=int(os.getenv("FANOUT_WORKERS", "16")), thread_name_prefix="fanout")
+
+
+def _submit(func):
+    """Submit to the pool, or to a fresh thread when already on a pool worker.
+
+    Nested fan-outs (a source that fans out itself) would otherwise wait on
+    tasks queued behind them and could stall the whole pool.
+    """
+    if not threading.current_thread().name.startswith("fanout"):
+        return fanout_pool.submit(func)
+    future = Future()
+
+    def run():
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(func())
+            except BaseException as e:
+                future.set_exception(e)
+
+    threading.Thread(target=run, daemon=True, name="fanout-nested").start()
+    return future
+
+
+def _fallback_value(fallback):
+    return fallback() if callable(fallback) else fallback
+
+
+def gather(sources, label="fan-out"):
+    """Run ``sources`` concurrently.
+
+    ``sources`` maps a name to (func, timeout_seconds, fallback); fallback is
+    a value or a zero-argument callable. Returns {name: result}.
+    """
+    started = time.time()
+    futures = {name: (_submit(func), timeout, fallback)
+               for name, (func, timeout, fallback) in sources.items()}
+
+    results = {}
+    for name, (future, timeout, fallback) in futures.items():
+        remaining = max(0.0, started + timeout - time.time())
+        try:
+            results[name] = future.result(timeout=remaining)
+        except Exception as e:
+            reason = 'timed out' if future.running() or not future.done() else f"failed: {e}"
+            logger.warning("⚠️ %s: %s %s - using fallback", label, name, reason)
+            results[name] = _fallback_value(fallback)
+    logger.info("⏱️ %s finished in %.2fs", label, time.time() - started)
+    return results
@@ -0,0 +1,102 @@
+"""
+Pooled outbound HTTP
+
+Each upstream (Telegram, M-Pesa, Cloudinary, ...) gets its own
+requests.Session with a keep-alive connection pool, a default timeout and a
+retry policy. Retries only apply to idempotent methods (GET/HEAD/OPTIONS),
+so a sendMessage or STK push is never sent twice. Per-upstream call counts,
+errors and latency are kept for the health endpoint.
+"""
+
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class Upstream:
+    """A pooled session for one remote service"""
+
+    def __init__(self, name, timeout=(5, 30), retries=2, backoff_factor=0.5, pool_size=20):
+        self.name = name
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'errors': 0, 'total_seconds': 0.0, 'status': {}}
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        started = time.time()
+        try:
+            response = self.session.request(method, url, **kwargs)
+            self._record(time.time() - started, response.status_code)
+            return response
+        except Exception:
+            self._record(time.time() - started, None)
+            raise
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _record(self, seconds, status_code):
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['total_seconds'] += seconds
+            if status_code is None or status_code >= 400:
+                self.stats['errors'] += 1
+            key = str(status_code) if status_code is not None else 'exception'
+            self.stats['status'][key] = self.stats['status'].get(key, 0) + 1
+
+    def get_stats(self):
+        with self._lock:
+            requests_made = self.stats['requests']
+            return {
+                **self.stats,
+                'status': dict(self.stats['status']),
+                'avg_seconds': round(self.stats['total_seconds'] / requests_made, 3) if requests_made else 0.0
+            }
+
+
+class HttpClient:
+    """Registry of named upstreams"""
+
+    def __init__(self):
+        self._upstreams = {}
+
+    def register(self, name, **kwargs):
+        self._upstreams[name] = Upstream(name, **kwargs)
+        return self._upstreams[name]
+
+    def upstream(self, name):
+        if name not in self._upstreams:
+            self.register(name)
+        return self._upstreams[name]
+
+    def get_stats(self):
+        return {name: upstream.get_stats() for name, upstream in self._upstreams.items()}
+
+
+# Global instance with per-host timeouts (connect, read)
+http_client = HttpClient()
+telegram_http = http_client.register('telegram', timeout=(5, 10), retries=2)
+telegram_files_http = http_client.register('telegram_files', timeout=(5, 30), retries=2)
+mpesa_http = http_client.register('mpesa', timeout=(5, 30), retries=2, pool_size=10)
+cloudinary_http = http_client.register('cloudinary', timeout=(5, 30), retries=2)
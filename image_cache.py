@@ -0,0 +1,183 @@
+"""
+Content-addressed index of uploaded images
+
+Originals are indexed by exact keys (sha256 of the bytes, Telegram
+file_unique_id, Cloudinary etag), so a photo a merchant sends again maps
+back to the URL we already have. Derived edits are indexed by (original
+URL, edit spec). Everything lives in one in-process LRU.
+
+Originals also carry a 64-bit perceptual hash. A perceptual match is only a
+hint (logged and counted): product shots with the same shape in different
+colours collide, so it never stands in for the merchant's own upload.
+
+Perceptual hashes come from Cloudinary (upload with phash=True) or, for
+bytes we hold locally, from a dHash computed with Pillow when it is
+installed. The two algorithms differ, so hashes are only compared within
+the same kind. Near-duplicate lookups use four 16-bit bands: two hashes
+within PHASH_DISTANCE (<= 3) bits must agree exactly on at least one band.
+
+Settings (env):
+    IMAGE_INDEX_SIZE  originals + variants kept (default 5000)
+"""
+
+import io
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from app_logging import get_logger
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = get_logger(__name__)
+
+PHASH_DISTANCE = 3
+_BANDS = 4
+
+
+def exact_digest(data):
+    return f"sha256:{hashlib.sha256(data).hexdigest()}"
+
+
+def perceptual_hash(data):
+    """64-bit difference hash of image bytes, or None without Pillow"""
+    if Image is None:
+        return None
+    try:
+        image = Image.open(io.BytesIO(data)).convert('L').resize((9, 8), Image.LANCZOS)
+        pixels = list(image.getdata())
+    except Exception as e:
+        logger.warning("⚠️ Perceptual hash failed: %s", e)
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def parse_phash(value):
+    """Cloudinary returns phash as a hex string"""
+    try:
+        return int(value, 16) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _bands(phash):
+    return [(i, (phash >> (16 * i)) & 0xFFFF) for i in range(_BANDS)]
+
+
+class ImageIndex:
+    """LRU index of originals (exact keys, perceptual hints) and derived variants"""
+
+    def __init__(self, max_entries=5000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # entry key -> record
+        self._exact = {}               # (scope, exact key) -> entry key
+        self._bands = {}               # (scope, kind, band, value) -> set of entry keys
+        self._lock = threading.Lock()
+        self.stats = {'exact_hits': 0, 'similar_hints': 0, 'variant_hits': 0, 'misses': 0, 'evictions': 0}
+
+    def _touch(self, entry_key):
+        self._entries.move_to_end(entry_key)
+        return self._entries[entry_key]['url']
+
+    def lookup(self, scope, exact_keys=()):
+        """Return the URL of a known original matching any exact key"""
+        with self._lock:
+            for key in exact_keys:
+                entry_key = self._exact.get((scope, key))
+                if entry_key is not None:
+                    self.stats['exact_hits'] += 1
+                    return self._touch(entry_key)
+            self.stats['misses'] += 1
+            return None
+
+    def similar(self, scope, phashes):
+        """URL of a perceptually near-identical original, as a hint only
+
+        ``phashes`` maps a hash kind ('dhash', 'cloudinary') to its value.
+        """
+        with self._lock:
+            for kind, phash in phashes.items():
+                if phash is None:
+                    continue
+                candidates = set()
+                for band, value in _bands(phash):
+                    candidates |= self._bands.get((scope, kind, band, value), set())
+                distance = lambda k: bin(self._entries[k]['phash'][kind] ^ phash).count('1')
+                best = min(candidates, default=None, key=distance)
+                if best is not None and distance(best) <= PHASH_DISTANCE:
+                    self.stats['similar_hints'] += 1
+                    return self._entries[best]['url']
+            return None
+
+    def add_original(self, scope, url, exact_keys=(), phashes=None):
+        with self._lock:
+            entry_key = ('original', scope, url)
+            record = self._entries.get(entry_key)
+            if record is None:
+                record = self._entries[entry_key] = {'url': url, 'scope': scope, 'exact': set(), 'phash': {}}
+            for key in exact_keys:
+                if key:
+                    record['exact'].add(key)
+                    self._exact[(scope, key)] = entry_key
+            for kind, phash in (phashes or {}).items():
+                if phash is not None and kind not in record['phash']:
+                    record['phash'][kind] = phash
+                    for band, value in _bands(phash):
+                        self._bands.setdefault((scope, kind, band, value), set()).add(entry_key)
+            self._entries.move_to_end(entry_key)
+            self._evict()
+
+    @staticmethod
+    def _variant_key(url, spec):
+        return ('variant', url, json.dumps(spec or {}, sort_keys=True, separators=(',', ':')))
+
+    def get_variant(self, url, spec):
+        with self._lock:
+            entry_key = self._variant_key(url, spec)
+            if entry_key in self._entries:
+                self.stats['variant_hits'] += 1
+                return self._touch(entry_key)
+            return None
+
+    def put_variant(self, url, spec, derived_url):
+        if not derived_url:
+            return
+        with self._lock:
+            entry_key = self._variant_key(url, spec)
+            self._entries[entry_key] = {'url': derived_url}
+            self._entries.move_to_end(entry_key)
+            self._evict()
+
+    def _evict(self):
+        while len(self._entries) > self.max_entries:
+            entry_key, record = self._entries.popitem(last=False)
+            self.stats['evictions'] += 1
+            if entry_key[0] != 'original':
+                continue
+            scope = record['scope']
+            for key in record['exact']:
+                if self._exact.get((scope, key)) == entry_key:
+                    del self._exact[(scope, key)]
+            for kind, phash in record['phash'].items():
+                for band, value in _bands(phash):
+                    bucket = self._bands.get((scope, kind, band, value))
+                    if bucket is not None:
+                        bucket.discard(entry_key)
+                        if not bucket:
+                            del self._bands[(scope, kind, band, value)]
+
+    def get_stats(self):
+        with self._lock:
+            return {**self.stats, 'size': len(self._entries), 'max_entries': self.max_entries}
+
+
+# Global instance
+image_index = ImageIndex(max_entries=int(os.getenv("IMAGE_INDEX_SIZE", "5000")))
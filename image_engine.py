@@ -0,0 +1,323 @@
+"""
+Local image transformation engine
+
+Applies the same named effects as the Cloudinary transformation URLs built
+in ImageService.apply_basic_edit (e_improve, e_sepia, e_vintage, b_white,
+...) and the same platform crop sizes, but on image bytes with
+NumPy/Pillow. Renders run in a process pool so they don't hold the GIL of
+the web workers, and results are cached by (source hash, edit spec). The
+pool is created lazily inside an already multi-threaded worker, so its
+processes are started with forkserver (spawn where that's unavailable)
+rather than fork.
+
+NumPy and Pillow are optional: without them LOCAL_ENGINE_AVAILABLE is False
+and callers keep using Cloudinary.
+
+Settings (env):
+    IMAGE_ENGINE_WORKERS   render processes (default 2)
+    IMAGE_ENGINE_CACHE_MB  rendered-output cache budget in MB (default 64)
+    IMAGE_ENGINE_TIMEOUT   seconds to wait for one render (default 20)
+"""
+
+import io
+import os
+import json
+import math
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+try:
+    import numpy as np
+    from PIL import Image, ImageFilter, ImageOps
+    LOCAL_ENGINE_AVAILABLE = True
+except ImportError:
+    LOCAL_ENGINE_AVAILABLE = False
+
+# Social media platform sizing (shared with the Cloudinary URL builder)
+PLATFORM_SIZES = {
+    'instagram': {'width': 1080, 'height': 1080, 'crop': 'fill'},
+    'facebook': {'width': 1200, 'height': 630, 'crop': 'fill'},
+    'twitter': {'width': 1024, 'height': 512, 'crop': 'fill'},
+    'whatsapp': {'width': 800, 'height': 800, 'crop': 'fill'}
+}
+
+# Named filters -> Cloudinary effect chain
+FILTER_EFFECTS = {
+    'background_removal': ["e_improve", "e_auto_contrast", "b_white"],
+    'studio_background': ["e_improve", "e_auto_brightness", "b_lightblue"],
+    'improve': ["e_improve", "e_auto_contrast"],
+    'sepia': ["e_sepia"],
+    'vintage': ["e_vintage"],
+    'enhance': ["e_improve", "e_auto_contrast", "e_auto_brightness"]
+}
+
+BACKGROUND_COLORS = {
+    'white': (255, 255, 255),
+    'lightblue': (173, 216, 230)
+}
+
+_LUMA = (0.299, 0.587, 0.114)
+_SEPIA = (
+    (0.393, 0.769, 0.189),
+    (0.349, 0.686, 0.168),
+    (0.272, 0.534, 0.131)
+)
+
+
+def _stretch(pixels, low_pct, high_pct, per_channel):
+    """Linear levels stretch between the given percentiles"""
+    if per_channel:
+        low = np.percentile(pixels, low_pct, axis=(0, 1))
+        high = np.percentile(pixels, high_pct, axis=(0, 1))
+    else:
+        luma = pixels @ np.asarray(_LUMA, dtype=np.float32)
+        low, high = np.percentile(luma, (low_pct, high_pct))
+    scale = 255.0 / np.maximum(high - low, 1.0)
+    return (pixels - low) * scale
+
+
+def _improve(pixels):
+    # Gentle per-channel levels (fixes colour casts) blended with the original
+    return 0.6 * _stretch(pixels, 0.5, 99.5, per_channel=True) + 0.4 * pixels
+
+
+def _auto_contrast(pixels):
+    return _stretch(pixels, 1.0, 99.0, per_channel=False)
+
+
+def _auto_brightness(pixels):
+    # Gamma so the mean luminance lands on mid-grey
+    mean = float(np.clip((pixels @ np.asarray(_LUMA, dtype=np.float32)).mean() / 255.0, 0.05, 0.95))
+    gamma = np.log(0.5) / np.log(mean)
+    return 255.0 * np.power(np.clip(pixels, 0, 255) / 255.0, gamma)
+
+
+def _sepia(pixels):
+    return pixels @ np.asarray(_SEPIA, dtype=np.float32).T
+
+
+def _vintage(pixels):
+    height, width = pixels.shape[:2]
+    toned = 0.55 * _sepia(pixels) + 0.45 * pixels
+    # Faded blacks and softened contrast
+    toned = 20.0 + toned * 0.85
+    # Radial vignette
+    y = np.linspace(-1.0, 1.0, height, dtype=np.float32)[:, None]
+    x = np.linspace(-1.0, 1.0, width, dtype=np.float32)[None, :]
+    vignette = 1.0 - 0.35 * np.clip(x * x + y * y - 0.3, 0.0, 1.0)
+    return toned * vignette[..., None]
+
+
+_PIXEL_EFFECTS = {
+    'e_improve': _improve,
+    'e_auto_contrast': _auto_contrast,
+    'e_auto_brightness': _auto_brightness,
+    'e_sepia': _sepia,
+    'e_vintage': _vintage
+}
+
+
+def _decode(source_bytes):
+    """Open image bytes upright, as RGB or RGBA"""
+    image = Image.open(io.BytesIO(source_bytes))
+    image = ImageOps.exif_transpose(image)
+    return image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+
+def _finish(image, effects, size, quality):
+    """Flatten, resize, apply effects and encode as JPEG"""
+    # b_<colour> fills transparent areas, as Cloudinary does
+    background = next((BACKGROUND_COLORS[e[2:]] for e in effects
+                       if e.startswith('b_') and e[2:] in BACKGROUND_COLORS), (255, 255, 255))
+    if image.mode == 'RGBA':
+        canvas = Image.new('RGBA', image.size, background + (255,))
+        image = Image.alpha_composite(canvas, image)
+    image = image.convert('RGB')
+
+    if size:
+        image = ImageOps.fit(image, (size['width'], size['height']), Image.LANCZOS)
+    if 'e_improve' in effects:
+        image = image.filter(ImageFilter.UnsharpMask(radius=1.5, percent=60, threshold=2))
+
+    pixels = np.asarray(image, dtype=np.float32)
+    for effect in effects:
+        op = _PIXEL_EFFECTS.get(effect)
+        if op is not None:
+            pixels = op(pixels)
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def _render(source_bytes, effects, size, quality):
+    """Render one variant (runs in a worker process)"""
+    return _finish(_decode(source_bytes), effects, size, quality)
+
+
+def _prepare(source_bytes, sizes):
+    """Decode once and downscale to the smallest image every target can be cut from.
+
+    Returns (mode, dimensions, raw pixels) so variants can be rendered from it
+    in parallel without decoding the source again.
+    """
+    image = _decode(source_bytes)
+    width, height = image.size
+    scale = max([max(s['width'] / width, s['height'] / height) for s in sizes if s] or [1.0])
+    if scale < 1.0:
+        image = image.resize((math.ceil(width * scale), math.ceil(height * scale)), Image.LANCZOS)
+    return image.mode, image.size, image.tobytes()
+
+
+def _render_prepared(prepared, effects, size, quality):
+    mode, dimensions, raw = prepared
+    return _finish(Image.frombytes(mode, dimensions, raw), effects, size, quality)
+
+
+def _pool_context():
+    """forkserver (or spawn): forking copies locks held by the worker's other threads"""
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+class LocalImageEngine:
+    """Process-pool renderer with an LRU cache of rendered output"""
+
+    def __init__(self, workers=2, cache_bytes=64 * 1024 * 1024, timeout=20.0, quality=85):
+        self.workers = workers
+        self.cache_bytes = cache_bytes
+        self.timeout = timeout
+        self.quality = quality
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._lock = threading.Lock()
+        self.stats = {'renders': 0, 'hits': 0, 'errors': 0, 'evictions': 0}
+
+    @property
+    def available(self):
+        return LOCAL_ENGINE_AVAILABLE
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=_pool_context())
+        return self._pool
+
+    @staticmethod
+    def effects_for(edits):
+        """The effect chain and crop size for an apply_basic_edit-style edit spec"""
+        effects = list(FILTER_EFFECTS.get(edits.get('filter', ''), []))
+        size = PLATFORM_SIZES.get(edits.get('platform', 'instagram'))
+        return effects, size
+
+    def cache_key(self, source_bytes, edits):
+        spec = json.dumps(edits, sort_keys=True, separators=(',', ':'))
+        return f"{hashlib.sha256(source_bytes).hexdigest()}:{spec}"
+
+    def _cache_get(self, key):
+        with self._lock:
+            output = self._cache.get(key)
+            if output is not None:
+                self._cache.move_to_end(key)
+                self.stats['hits'] += 1
+            return output
+
+    def _cache_put(self, key, output):
+        with self._lock:
+            if key in self._cache:
+                return
+            self._cache[key] = output
+            self._cache_size += len(output)
+            while self._cache_size > self.cache_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_size -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def render(self, source_bytes, edits):
+        """Return JPEG bytes for ``source_bytes`` with ``edits`` applied, or None"""
+        if not LOCAL_ENGINE_AVAILABLE:
+            return None
+        key = self.cache_key(source_bytes, edits)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+
+        effects, size = self.effects_for(edits)
+        try:
+            output = self.pool.submit(_render, source_bytes, effects, size, self.quality).result(timeout=self.timeout)
+        except Exception as e:
+            with self._lock:
+                self.stats['errors'] += 1
+            logger.error("❌ Local render failed: %s", e)
+            return None
+
+        with self._lock:
+            self.stats['renders'] += 1
+        self._cache_put(key, output)
+        return output
+
+    def render_batch(self, source_bytes, edits_list):
+        """Render several edit specs of one source; returns outputs in order (None on failure).
+
+        The source is decoded and downscaled once, then the variants are
+        rendered in parallel from that shared intermediate.
+        """
+        if not LOCAL_ENGINE_AVAILABLE:
+            return [None] * len(edits_list)
+        keys = [self.cache_key(source_bytes, edits) for edits in edits_list]
+        outputs = [self._cache_get(key) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if not missing:
+            return outputs
+
+        plans = [self.effects_for(edits_list[i]) for i in missing]
+        try:
+            prepared = self.pool.submit(_prepare, source_bytes, [size for _, size in plans]).result(timeout=self.timeout)
+            futures = [self.pool.submit(_render_prepared, prepared, effects, size, self.quality)
+                       for effects, size in plans]
+        except Exception as e:
+            with self._lock:
+                self.stats['errors'] += 1
+            logger.error("❌ Local batch render failed: %s", e)
+            return outputs
+
+        for i, future in zip(missing, futures):
+            try:
+                outputs[i] = future.result(timeout=self.timeout)
+            except Exception as e:
+                with self._lock:
+                    self.stats['errors'] += 1
+                logger.error("❌ Local render failed for %s: %s", edits_list[i], e)
+                continue
+            with self._lock:
+                self.stats['renders'] += 1
+            self._cache_put(keys[i], outputs[i])
+        return outputs
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                **self.stats,
+                'available': LOCAL_ENGINE_AVAILABLE,
+                'cached': len(self._cache),
+                'cache_bytes': self._cache_size
+            }
+
+
+# Global instance
+image_engine = LocalImageEngine(
+    workers=int(os.getenv("IMAGE_ENGINE_WORKERS", "2")),
+    cache_bytes=int(os.getenv("IMAGE_ENGINE_CACHE_MB", "64")) * 1024 * 1024,
+    timeout=float(os.getenv("IMAGE_ENGINE_TIMEOUT", "20"))
+)
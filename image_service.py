@@ -6,6 +6,14 @@ import requests
 import base64
 from io import BytesIO
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from llm_gateway import llm_gateway
+from http_client import cloudinary_http
+from image_engine import image_engine, PLATFORM_SIZES, FILTER_EFFECTS
+from image_cache import image_index, exact_digest, perceptual_hash, parse_phash
+from app_logging import get_logger
+
+logger = get_logger(__name__)
 
 # Configure Cloudinary
 try:
@@ -15,9 +23,18 @@ try:
         api_secret=os.getenv('CLOUDINARY_API_SECRET'),
         secure=True
     )
-    print("✅ Cloudinary configured successfully")
+    logger.info("✅ Cloudinary configured successfully")
 except Exception as e:
-    print(f"❌ Cloudinary configuration failed: {e}")
+    logger.error("❌ Cloudinary configuration failed: %s", e)
+
+# Bounded pool for Cloudinary uploads so a burst of photos can't open
+# an unbounded number of upload connections
+UPLOAD_WORKERS = int(os.getenv('CLOUDINARY_UPLOAD_WORKERS', '4'))
+UPLOAD_TIMEOUT = float(os.getenv('CLOUDINARY_UPLOAD_TIMEOUT', '90'))
+upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="cloudinary-upload")
+
+# 'cloudinary' builds transformation URLs; 'local' renders edits here and uploads the result
+IMAGE_EDIT_ENGINE = os.getenv('IMAGE_EDIT_ENGINE', 'cloudinary').lower()
 
 class ImageService:
     def __init__(self):
@@ -27,12 +44,30 @@ class ImageService:
             os.getenv('CLOUDINARY_API_SECRET')
         ])
     
-    def upload_image(self, image_data, user_id, image_type="upload"):
-        """Upload image to Cloudinary"""
+    def upload_image(self, image_data, user_id, image_type="upload", content_key=None):
+        """Upload image to Cloudinary
+
+        ``image_data`` can be bytes, a file-like object or a remote URL
+        (Cloudinary fetches URLs itself, so nothing passes through this server).
+        Content we've already uploaded for this user - same bytes, same
+        ``content_key`` or same Cloudinary etag - returns the existing URL.
+        """
         if not self.cloudinary_configured:
-            print("❌ Cloudinary not configured")
+            logger.error("❌ Cloudinary not configured")
             return None
             
+        # Originals and each kind of derived output are deduplicated separately
+        scope = user_id if image_type == "upload" else f"{user_id}:{image_type}"
+        exact_keys = [content_key] if content_key else []
+        phashes = {}
+        if isinstance(image_data, (bytes, bytearray)):
+            exact_keys.append(exact_digest(image_data))
+            phashes['dhash'] = perceptual_hash(image_data)
+        existing = image_index.lookup(scope, exact_keys)
+        if existing:
+            logger.info("✅ Duplicate image - reusing %s", existing)
+            return existing
+
         try:
             # Generate unique public ID
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -46,16 +81,67 @@ class ImageService:
                 resource_type="image",
                 overwrite=True,
                 quality="auto",
-                fetch_format="auto"
+                fetch_format="auto",
+                phash=True
             )
             
-            print(f"✅ Image uploaded successfully: {result['secure_url']}")
-            return result['secure_url']
+            image_url = result['secure_url']
+            if result.get('etag'):
+                exact_keys.append(f"etag:{result['etag']}")
+            phashes['cloudinary'] = parse_phash(result.get('phash'))
+
+            # Identical content we only saw after upload (remote URLs): keep the first copy
+            existing = image_index.lookup(scope, exact_keys[-1:]) if result.get('etag') else None
+            if existing:
+                logger.info("✅ Duplicate image - reusing %s", existing)
+                if result['public_id'] not in existing:
+                    upload_pool.submit(self._destroy, result['public_id'])
+                image_index.add_original(scope, existing, exact_keys, phashes)
+                return existing
+
+            similar = image_index.similar(scope, phashes)
+            if similar:
+                logger.debug("🔍 Looks like earlier upload %s - keeping the new one", similar)
+
+            image_index.add_original(scope, image_url, exact_keys, phashes)
+            logger.info("✅ Image uploaded successfully: %s", image_url)
+            return image_url
             
         except Exception as e:
-            print(f"❌ Image upload error: {e}")
+            logger.error("❌ Image upload error: %s", e)
             return None
+
+    def _destroy(self, public_id):
+        try:
+            cloudinary.uploader.destroy(public_id, resource_type="image")
+        except Exception as e:
+            logger.warning("⚠️ Could not delete duplicate upload %s: %s", public_id, e)
     
+    def upload_image_async(self, image_data, user_id, image_type="upload", content_key=None):
+        """Queue an upload on the shared pool; returns a Future with the URL (or None)"""
+        return upload_pool.submit(self.upload_image, image_data, user_id, image_type, content_key)
+
+    def upload_streamed(self, file_url, user_id, http, image_type="upload", content_key=None):
+        """Stream ``file_url`` from the source straight into the Cloudinary upload.
+
+        The file is handed over as a file object, so it isn't buffered here,
+        and ``file_url`` (which may embed a token) never leaves this server.
+        """
+        try:
+            response = http.get(file_url, stream=True)
+            if response.status_code != 200:
+                logger.error("❌ Image download failed: %s", response.status_code)
+                return None
+            try:
+                response.raw.decode_content = True
+                future = self.upload_image_async(response.raw, user_id, image_type, content_key)
+                return future.result(timeout=UPLOAD_TIMEOUT)
+            finally:
+                response.close()
+        except Exception as e:
+            logger.error("❌ Streamed upload error: %s", e)
+            return None
+
     def apply_basic_edit(self, image_url, edits=None):
         """Apply basic edits to image"""
         if edits is None:
@@ -64,36 +150,14 @@ class ImageService:
         try:
             transformations = []
             
-            # Social media platform sizing
-            platform_sizes = {
-                'instagram': {'width': 1080, 'height': 1080, 'crop': 'fill'},
-                'facebook': {'width': 1200, 'height': 630, 'crop': 'fill'},
-                'twitter': {'width': 1024, 'height': 512, 'crop': 'fill'},
-                'whatsapp': {'width': 800, 'height': 800, 'crop': 'fill'}
-            }
-            
             # Apply platform-specific sizing
             platform = edits.get('platform', 'instagram')
-            if platform in platform_sizes:
-                size = platform_sizes[platform]
+            if platform in PLATFORM_SIZES:
+                size = PLATFORM_SIZES[platform]
                 transformations.append(f"c_{size['crop']},w_{size['width']},h_{size['height']}")
             
             # Apply specialized background effects
-            filter_type = edits.get('filter', '')
-            if filter_type == 'background_removal':
-                # Simulate background removal with white background
-                transformations.extend(["e_improve", "e_auto_contrast", "b_white"])
-            elif filter_type == 'studio_background':
-                # Professional studio look
-                transformations.extend(["e_improve", "e_auto_brightness", "b_lightblue"])
-            elif filter_type == 'improve':
-                transformations.extend(["e_improve", "e_auto_contrast"])
-            elif filter_type == 'sepia':
-                transformations.append("e_sepia")
-            elif filter_type == 'vintage':
-                transformations.append("e_vintage")
-            elif filter_type == 'enhance':
-                transformations.extend(["e_improve", "e_auto_contrast", "e_auto_brightness"])
+            transformations.extend(FILTER_EFFECTS.get(edits.get('filter', ''), []))
             
             # Enhance image quality
             transformations.extend(["q_auto", "f_auto"])
@@ -109,24 +173,91 @@ class ImageService:
                 
                    # Apply transformations
                    transformation_str = '/'.join(transformations)
-                   transformed_url = f"{base_url}/{transformation_str}/{version_and_path}"
+                   transformed_url = f"{base_url}/{transformation_str}/{public_id_with_version}"
                    
-                   print(f"✅ Generated transformed URL: {transformed_url}")
+                   logger.info("✅ Generated transformed URL: %s", transformed_url)
                    return transformed_url
                 else:
-                    print(f"⚠️ Could not parse Cloudinary URL: {image_url}")
+                    logger.warning("⚠️ Could not parse Cloudinary URL: %s", image_url)
                     return image_url
                   
         except Exception as e:
-            print(f"❌ Image editing error: {e}")
+            logger.error("❌ Image editing error: %s", e)
             return image_url  # Return original if editing fails
     
+    def render_local(self, image_url, user_id, edits=None):
+        """Apply edits with the local engine and upload the rendered image"""
+        if not image_engine.available:
+            return None
+        try:
+            response = cloudinary_http.get(image_url)
+            if response.status_code != 200:
+                logger.error("❌ Source image download failed: %s", response.status_code)
+                return None
+            output = image_engine.render(response.content, edits or {})
+            if output is None:
+                return None
+            return self.upload_image(output, user_id, image_type=f"edit_{(edits or {}).get('filter') or 'basic'}")
+        except Exception as e:
+            logger.error("❌ Local edit error: %s", e)
+            return None
+
+    def apply_edit(self, image_url, user_id, edits=None):
+        """Apply edits with the configured engine, falling back to Cloudinary URLs"""
+        cached = image_index.get_variant(image_url, edits)
+        if cached:
+            return cached
+        edited_url = None
+        if IMAGE_EDIT_ENGINE == 'local':
+            edited_url = self.render_local(image_url, user_id, edits)
+        if not edited_url:
+            edited_url = self.apply_basic_edit(image_url, edits)
+        if edited_url and edited_url != image_url:
+            image_index.put_variant(image_url, edits, edited_url)
+        return edited_url
+
+    def render_kit(self, image_url, user_id, platforms=None, filters=None):
+        """Produce every platform size (x filter) of one image in one go.
+
+        Returns a list of {'platform', 'filter', 'url'} in request order.
+        With the local engine the source is downloaded and decoded once, the
+        variants are rendered in parallel and uploaded concurrently;
+        otherwise each variant is a Cloudinary transformation URL.
+        """
+        platforms = platforms or list(PLATFORM_SIZES.keys())
+        specs = [{'platform': platform, 'filter': filter_type}
+                 for filter_type in (filters or ['']) for platform in platforms]
+        urls = [image_index.get_variant(image_url, spec) for spec in specs]
+
+        missing = [i for i, url in enumerate(urls) if not url]
+        if missing and IMAGE_EDIT_ENGINE == 'local' and image_engine.available:
+            try:
+                response = cloudinary_http.get(image_url)
+                if response.status_code == 200:
+                    outputs = image_engine.render_batch(response.content, [specs[i] for i in missing])
+                    uploads = {
+                        i: self.upload_image_async(output, user_id, f"kit_{specs[i]['platform']}_{specs[i]['filter'] or 'basic'}")
+                        for i, output in zip(missing, outputs) if output is not None
+                    }
+                    for i, future in uploads.items():
+                        urls[i] = future.result(timeout=UPLOAD_TIMEOUT)
+                else:
+                    logger.error("❌ Source image download failed: %s", response.status_code)
+            except Exception as e:
+                logger.error("❌ Local kit render error: %s", e)
+
+        kit = []
+        for spec, url in zip(specs, urls):
+            if not url:
+                url = self.apply_basic_edit(image_url, spec)
+            if url and url != image_url:
+                image_index.put_variant(image_url, spec, url)
+            kit.append({**spec, 'url': url})
+        return kit
+
     def generate_caption(self, image_url, business_context):
         """Generate AI caption for image using OpenAI"""
         try:
-            from openai import OpenAI
-            client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-            
             # Enhanced prompt for African business context
             prompt = f"""
             Create 3 engaging social media captions for this image from {business_context}.
@@ -152,7 +283,7 @@ class ImageService:
             Make it authentic and relatable for African customers.
             """
             
-            response = client.chat.completions.create(
+            caption = llm_gateway.complete(
                 model="gpt-3.5-turbo",
                 messages=[
                     {"role": "system", "content": "You are a social media expert specializing in African business marketing. Create authentic, engaging captions that resonate with local audiences."},
@@ -161,13 +292,11 @@ class ImageService:
                 max_tokens=400,
                 temperature=0.8,
             )
-            
-            caption = response.choices[0].message.content.strip()
-            print(f"✅ Caption generated: {len(caption)} characters")
+            logger.info("✅ Caption generated: %s characters", len(caption))
             return caption
             
         except Exception as e:
-            print(f"❌ Caption generation error: {e}")
+            logger.error("❌ Caption generation error: %s", e)
             # Fallback captions
             return f"""1. [Instagram] ✨ Looking fresh! Perfect for any occasion. Who's rocking this style? 👀 #FashionKE #StyleGoals #NairobiFashion
 
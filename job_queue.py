@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class BackgroundJobQueue:
+    """Bounded worker pool that runs jobs off the request thread.
+
+    Jobs submitted with the same key run one after another in submission
+    order, so two messages from one chat never race on the same session.
+    Jobs with different keys run in parallel up to ``max_workers``.
+    """
+
+    def __init__(self, max_workers=8, max_pending=500, name="jobs"):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_count = 0
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+
+    def submit(self, key, func, *args, **kwargs):
+        """Queue ``func(*args, **kwargs)`` behind any earlier job for ``key``.
+
+        Returns False without queueing when the pending limit is reached, so
+        the caller can decide how to shed load.
+        """
+        with self._lock:
+            if self._pending_count >= self.max_pending:
+                self.stats['rejected'] += 1
+                return False
+
+            self._pending_count += 1
+            self.stats['submitted'] += 1
+
+            if key in self._pending:
+                # A runner is already draining this key - just append
+                self._pending[key].append((func, args, kwargs))
+                return True
+
+            self._pending[key] = deque([(func, args, kwargs)])
+
+        self._executor.submit(self._drain, key)
+        return True
+
+    def _drain(self, key):
+        """Run every queued job for ``key`` until its queue is empty"""
+        while True:
+            with self._lock:
+                jobs = self._pending.get(key)
+                if not jobs:
+                    self._pending.pop(key, None)
+                    return
+                func, args, kwargs = jobs.popleft()
+                self._pending_count -= 1
+
+            try:
+                func(*args, **kwargs)
+                outcome = 'completed'
+            except Exception:
+                outcome = 'failed'
+                logger.exception("❌ %s JOB ERROR for %s", self.name.upper(), key)
+            with self._lock:
+                self.stats[outcome] += 1
+
+    def pending(self):
+        """Number of jobs queued but not yet started"""
+        with self._lock:
+            return self._pending_count
+
+    def get_stats(self):
+        """Snapshot of queue counters for health endpoints"""
+        with self._lock:
+            return {
+                **self.stats,
+                'pending': self._pending_count,
+                'active_keys': len(self._pending),
+                'max_workers': self.max_workers,
+                'max_pending': self.max_pending
+            }
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+# Global instance used by the Telegram webhook
+telegram_jobs = BackgroundJobQueue(
+    max_workers=int(os.getenv("TELEGRAM_WORKERS", "8")),
+    max_pending=int(os.getenv("TELEGRAM_MAX_PENDING", "500")),
+    name="telegram"
+)
@@ -0,0 +1,116 @@
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class PromptCache:
+    """LRU + TTL cache for completions of deterministic prompts.
+
+    Keys are a fingerprint of the normalized messages, model, temperature and
+    max_tokens, so users whose anonymized profile produces the same prompt
+    share one completion. With ``variants`` > 1 the cache keeps generating
+    until it holds that many completions for a key, then serves them
+    round-robin so repeat users don't always see identical copy.
+    """
+
+    def __init__(self, max_entries=1000, ttl_seconds=21600, variants=1):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.variants = max(1, variants)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    @staticmethod
+    def normalize(text):
+        """Collapse whitespace so indentation changes don't split the cache"""
+        return re.sub(r'\s+', ' ', text or '').strip()
+
+    def make_key(self, messages, model, temperature, max_tokens):
+        payload = json.dumps({
+            'messages': [(m.get('role'), self.normalize(m.get('content'))) for m in messages],
+            'model': model,
+            'temperature': temperature,
+            'max_tokens': max_tokens
+        }, separators=(',', ':'))
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Return a cached completion, or None if a new one should be generated"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if now - entry['created_at'] > self.ttl_seconds:
+                del self._entries[key]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                return None
+            if len(entry['responses']) < self.variants:
+                # Still collecting variants for this prompt
+                self.stats['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            response = entry['responses'][entry['next'] % len(entry['responses'])]
+            entry['next'] += 1
+            self.stats['hits'] += 1
+            return response
+
+    def put(self, key, response):
+        if not response:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = {'responses': [], 'next': 0, 'created_at': time.time()}
+            if len(entry['responses']) < self.variants:
+                entry['responses'].append(response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def get_or_create(self, messages, model, temperature, max_tokens, create):
+        """Serve from cache or call ``create()`` and remember its result"""
+        key = self.make_key(messages, model, temperature, max_tokens)
+        cached = self.get(key)
+        if cached is not None:
+            logger.info("✅ LLM CACHE HIT: %s", key[:12])
+            return cached
+
+        response = create()
+        self.put(key, response)
+        return response
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_rate': round(self.stats['hits'] / lookups, 3) if lookups else 0.0,
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'variants': self.variants
+            }
+
+
+# Global instance
+llm_cache = PromptCache(
+    max_entries=int(os.getenv("LLM_CACHE_SIZE", "1000")),
+    ttl_seconds=int(os.getenv("LLM_CACHE_TTL", "21600")),
+    variants=int(os.getenv("LLM_CACHE_VARIANTS", "1"))
+)
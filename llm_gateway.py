@@ -0,0 +1,167 @@
+"""
+Shared OpenAI gateway
+
+One client per process with a keep-alive connection pool, so warm requests
+skip the TCP/TLS handshake. Every call goes through a concurrency semaphore
+and is retried with jittered exponential backoff on transient errors.
+
+Settings (env):
+    OPENAI_TIMEOUT          read timeout in seconds (default 60)
+    OPENAI_CONNECT_TIMEOUT  connect timeout in seconds (default 10)
+    OPENAI_MAX_RETRIES      retries after the first attempt (default 2)
+    OPENAI_MAX_CONCURRENCY  outbound requests in flight (default 16)
+"""
+
+import os
+import time
+import random
+import threading
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class LLMGateway:
+    """Pooled, rate-capped access to the OpenAI chat completions API"""
+
+    def __init__(self, api_key=None, timeout=60.0, connect_timeout=10.0,
+                 max_retries=2, max_concurrency=16, backoff_base=0.5, backoff_max=8.0):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.max_concurrency = max_concurrency
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'retries': 0, 'errors': 0, 'total_seconds': 0.0}
+
+    @property
+    def client(self):
+        """The shared OpenAI client, created on first use"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import httpx
+                    from openai import OpenAI
+                    http_client = httpx.Client(
+                        timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                        limits=httpx.Limits(
+                            max_connections=self.max_concurrency,
+                            max_keepalive_connections=self.max_concurrency,
+                            keepalive_expiry=120
+                        )
+                    )
+                    # Retries are handled here so they share the semaphore and backoff policy
+                    self._client = OpenAI(
+                        api_key=self.api_key or os.getenv("OPENAI_API_KEY"),
+                        http_client=http_client,
+                        max_retries=0
+                    )
+        return self._client
+
+    def _is_retryable(self, error):
+        import openai
+        if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError, openai.RateLimitError)):
+            return True
+        status = getattr(error, 'status_code', None)
+        return isinstance(error, openai.APIStatusError) and status is not None and status >= 500
+
+    def _backoff(self, attempt):
+        # Full jitter: sleep a random amount up to the exponential cap
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _record(self, key, amount=1):
+        with self._stats_lock:
+            self.stats[key] += amount
+
+    def _call_with_retries(self, call):
+        """Run ``call()`` and retry transient failures with jittered backoff"""
+        attempt = 0
+        while True:
+            started = time.time()
+            try:
+                self._record('requests')
+                return call()
+            except Exception as e:
+                if attempt >= self.max_retries or not self._is_retryable(e):
+                    self._record('errors')
+                    raise
+                error = e
+            finally:
+                self._record('total_seconds', time.time() - started)
+
+            delay = self._backoff(attempt)
+            attempt += 1
+            self._record('retries')
+            logger.warning("⚠️ OpenAI call failed (%s), retry %s/%s in %.1fs", type(error).__name__, attempt, self.max_retries, delay)
+            time.sleep(delay)
+
+    def create(self, **kwargs):
+        """Call chat.completions.create with pooling, concurrency cap and retries"""
+        def call():
+            with self._semaphore:
+                return self.client.chat.completions.create(**kwargs)
+        return self._call_with_retries(call)
+
+    def _params(self, messages, model, max_tokens, temperature, kwargs):
+        params = {'model': model, 'messages': messages, **kwargs}
+        if max_tokens is not None:
+            params['max_tokens'] = max_tokens
+        if temperature is not None:
+            params['temperature'] = temperature
+        return params
+
+    def complete(self, messages, model="gpt-4o-mini", max_tokens=None, temperature=None, **kwargs):
+        """Return the stripped text of a single chat completion"""
+        response = self.create(**self._params(messages, model, max_tokens, temperature, kwargs))
+        return response.choices[0].message.content.strip()
+
+    def stream(self, messages, model="gpt-4o-mini", max_tokens=None, temperature=None, **kwargs):
+        """Yield text deltas as the completion is generated.
+
+        Only opening the stream is retried; the concurrency slot is held
+        until the stream is exhausted or closed.
+        """
+        params = self._params(messages, model, max_tokens, temperature, kwargs)
+        params['stream'] = True
+
+        def open_stream():
+            self._semaphore.acquire()
+            try:
+                return self.client.chat.completions.create(**params)
+            except Exception:
+                self._semaphore.release()
+                raise
+
+        response = self._call_with_retries(open_stream)
+        try:
+            for chunk in response:
+                if chunk.choices and chunk.choices[0].delta and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            # Give the connection back to the pool even if the consumer stopped early
+            if hasattr(response, 'close'):
+                response.close()
+            self._semaphore.release()
+
+    def get_stats(self):
+        with self._stats_lock:
+            requests = self.stats['requests']
+            return {
+                **self.stats,
+                'avg_seconds': round(self.stats['total_seconds'] / requests, 3) if requests else 0.0,
+                'max_concurrency': self.max_concurrency
+            }
+
+
+# Global instance shared by every handler
+llm_gateway = LLMGateway(
+    timeout=float(os.getenv("OPENAI_TIMEOUT", "60")),
+    connect_timeout=float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10")),
+    max_retries=int(os.getenv("OPENAI_MAX_RETRIES", "2")),
+    max_concurrency=int(os.getenv("OPENAI_MAX_CONCURRENCY", "16"))
+)
@@ -0,0 +1,158 @@
+"""
+M-Pesa OAuth token cache
+
+Daraja access tokens last about an hour, so one token per
+(oauth_url, consumer_key) is cached and reused across STK pushes. A timer
+refreshes it shortly before it expires, and concurrent callers that find no
+usable token share a single in-flight fetch instead of each hitting the
+OAuth endpoint.
+
+Settings (env):
+    MPESA_TOKEN_REFRESH_MARGIN  seconds before expiry to refresh (default 300)
+"""
+
+import os
+import time
+import threading
+
+from http_client import mpesa_http
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class _TokenEntry:
+    def __init__(self):
+        self.token = None
+        self.expires_at = 0.0
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+        self.inflight = None  # threading.Event while a fetch is running
+        self.timer = None
+
+
+class MpesaTokenManager:
+    """Caches Daraja OAuth tokens with single-flight fetch and proactive refresh"""
+
+    def __init__(self, http, refresh_margin=300, default_ttl=3599, idle_timeout=7200):
+        self.http = http
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self.idle_timeout = idle_timeout
+        self._entries = {}
+        self._credentials = {}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'fetches': 0, 'errors': 0, 'background_refreshes': 0}
+
+    def _entry(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _TokenEntry()
+            return entry
+
+    def _fetch(self, oauth_url, consumer_key, consumer_secret):
+        """Request a new token; returns (token, expires_in) or (None, None)"""
+        try:
+            response = self.http.get(
+                f"{oauth_url}?grant_type=client_credentials",
+                auth=(consumer_key, consumer_secret)
+            )
+            if response.status_code == 200:
+                data = response.json()
+                return data['access_token'], int(data.get('expires_in') or self.default_ttl)
+            logger.error("❌ M-Pesa token error: %s - %s", response.status_code, response.text)
+        except Exception as e:
+            logger.error("❌ M-Pesa token exception: %s", e)
+        return None, None
+
+    def _refresh(self, key, entry):
+        """Fetch a token for ``key``, or wait for the fetch already in flight"""
+        with entry.lock:
+            event = entry.inflight
+            leader = event is None
+            if leader:
+                event = entry.inflight = threading.Event()
+
+        if not leader:
+            event.wait()
+            return entry.token if time.time() < entry.expires_at else None
+
+        oauth_url, consumer_key = key
+        try:
+            token, expires_in = self._fetch(oauth_url, consumer_key, self._credentials.get(key))
+            with self._lock:
+                self.stats['fetches'] += 1
+                if token is None:
+                    self.stats['errors'] += 1
+            if token is not None:
+                with entry.lock:
+                    entry.token = token
+                    entry.expires_at = time.time() + expires_in
+                self._schedule(key, entry, expires_in)
+            return token
+        finally:
+            with entry.lock:
+                entry.inflight = None
+            event.set()
+
+    def _schedule(self, key, entry, expires_in):
+        delay = max(1.0, expires_in - self.refresh_margin)
+        timer = threading.Timer(delay, self._background_refresh, args=(key, entry))
+        timer.daemon = True
+        with entry.lock:
+            if entry.timer is not None:
+                entry.timer.cancel()
+            entry.timer = timer
+        timer.start()
+
+    def _background_refresh(self, key, entry):
+        # Let tokens nobody has asked for in a while lapse instead of refreshing forever
+        if time.time() - entry.last_used > self.idle_timeout:
+            return
+        with self._lock:
+            self.stats['background_refreshes'] += 1
+        self._refresh(key, entry)
+
+    def get_token(self, oauth_url, consumer_key, consumer_secret):
+        """Return a valid access token for these credentials, or None"""
+        if not consumer_key or not consumer_secret:
+            return None
+        key = (oauth_url, consumer_key)
+        self._credentials[key] = consumer_secret
+        entry = self._entry(key)
+        entry.last_used = time.time()
+
+        with entry.lock:
+            if entry.token and time.time() < entry.expires_at - 30:
+                with self._lock:
+                    self.stats['hits'] += 1
+                return entry.token
+        return self._refresh(key, entry)
+
+    def invalidate(self, oauth_url, consumer_key):
+        """Drop a token the API rejected so the next call fetches a new one"""
+        with self._lock:
+            entry = self._entries.get((oauth_url, consumer_key))
+        if entry is not None:
+            with entry.lock:
+                entry.token = None
+                entry.expires_at = 0.0
+
+    def get_stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                **self.stats,
+                'tokens': {
+                    oauth_url: round(max(0.0, entry.expires_at - now))
+                    for (oauth_url, _), entry in self._entries.items()
+                }
+            }
+
+
+# Global instance on the pooled M-Pesa session
+mpesa_tokens = MpesaTokenManager(
+    mpesa_http,
+    refresh_margin=int(os.getenv("MPESA_TOKEN_REFRESH_MARGIN", "300"))
+)
@@ -0,0 +1,146 @@
+import os
+import copy
+import time
+import threading
+
+
+class ProfileCache:
+    """Two-level cache for rows of the ``profiles`` table.
+
+    - Request scope: a thread-local map cleared by end_request(), so one
+      message reads a profile at most once however many handlers ask for it.
+    - Cross-request: a short-TTL map shared by the worker's threads.
+
+    Entries are keyed by profile id, with a phone number -> id index and its
+    reverse (id -> phone numbers) so invalidation never scans. Callers
+    always get their own copy, since handlers mutate user_profile in place.
+    """
+
+    def __init__(self, ttl_seconds=30, max_entries=5000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._profiles = {}
+        self._phone_index = {}
+        self._phones_by_id = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {'request_hits': 0, 'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def _request_scope(self):
+        scope = getattr(self._local, 'scope', None)
+        if scope is None:
+            scope = self._local.scope = {}
+        return scope
+
+    def end_request(self):
+        """Forget everything cached for the current request"""
+        self._local.scope = None
+
+    def get_by_phone(self, phone_number, loader):
+        """Return the profile for ``phone_number``, calling ``loader()`` on a miss"""
+        scope = self._request_scope()
+        if phone_number in scope:
+            self.stats['request_hits'] += 1
+            return copy.deepcopy(scope[phone_number])
+
+        with self._lock:
+            profile_id = self._phone_index.get(phone_number)
+            entry = self._profiles.get(profile_id) if profile_id else None
+            if entry and time.time() - entry[1] <= self.ttl_seconds:
+                self.stats['hits'] += 1
+                scope[phone_number] = entry[0]
+                return copy.deepcopy(entry[0])
+
+        self.stats['misses'] += 1
+        profile = loader()
+        if profile:
+            self.put(profile, phone_number)
+        return copy.deepcopy(profile)
+
+    def get_by_id(self, profile_id, loader):
+        """Return the profile with ``profile_id``, calling ``loader()`` on a miss"""
+        with self._lock:
+            entry = self._profiles.get(profile_id)
+            if entry and time.time() - entry[1] <= self.ttl_seconds:
+                self.stats['hits'] += 1
+                return copy.deepcopy(entry[0])
+
+        self.stats['misses'] += 1
+        profile = loader()
+        if profile:
+            self.put(profile)
+        return copy.deepcopy(profile)
+
+    def put(self, profile, phone_number=None):
+        """Store a freshly read profile row"""
+        profile = copy.deepcopy(profile)
+        phone_number = phone_number or profile.get('phone_number')
+        profile_id = profile.get('id')
+        if phone_number:
+            self._request_scope()[phone_number] = profile
+        if not profile_id:
+            return
+
+        with self._lock:
+            if len(self._profiles) >= self.max_entries:
+                self._evict_expired()
+            if len(self._profiles) >= self.max_entries:
+                # Still full - drop the oldest entry
+                oldest = min(self._profiles, key=lambda k: self._profiles[k][1])
+                self._profiles.pop(oldest, None)
+                for phone in self._phones_by_id.pop(oldest, ()):
+                    self._phone_index.pop(phone, None)
+            self._profiles[profile_id] = (profile, time.time())
+            if phone_number:
+                self._index_phone(phone_number, profile_id)
+
+    def _index_phone(self, phone_number, profile_id):
+        previous = self._phone_index.get(phone_number)
+        if previous is not None and previous != profile_id:
+            self._unindex_phone(phone_number)
+        self._phone_index[phone_number] = profile_id
+        self._phones_by_id.setdefault(profile_id, set()).add(phone_number)
+
+    def _unindex_phone(self, phone_number):
+        profile_id = self._phone_index.pop(phone_number, None)
+        phones = self._phones_by_id.get(profile_id)
+        if phones is not None:
+            phones.discard(phone_number)
+            if not phones:
+                del self._phones_by_id[profile_id]
+
+    def invalidate(self, profile_id=None, phone_number=None):
+        """Drop a profile after it has been written"""
+        self.stats['invalidations'] += 1
+        scope = self._request_scope()
+        with self._lock:
+            if phone_number and not profile_id:
+                profile_id = self._phone_index.get(phone_number)
+            phones = self._phones_by_id.pop(profile_id, set()) if profile_id else set()
+            if phone_number:
+                phones.add(phone_number)
+            for phone in phones:
+                self._unindex_phone(phone)
+            self._profiles.pop(profile_id, None)
+
+        for phone in phones:
+            scope.pop(phone, None)
+        if profile_id:
+            for phone in [p for p, profile in scope.items() if profile.get('id') == profile_id]:
+                scope.pop(phone, None)
+
+    def _evict_expired(self):
+        now = time.time()
+        expired = [pid for pid, (_, stored_at) in self._profiles.items() if now - stored_at > self.ttl_seconds]
+        for pid in expired:
+            self._profiles.pop(pid, None)
+            for phone in self._phones_by_id.pop(pid, ()):
+                self._phone_index.pop(phone, None)
+
+    def get_stats(self):
+        with self._lock:
+            return {**self.stats, 'size': len(self._profiles), 'ttl_seconds': self.ttl_seconds}
+
+
+# Global instance
+profile_cache = ProfileCache(ttl_seconds=int(os.getenv("PROFILE_CACHE_TTL", "30")))
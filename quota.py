@@ -0,0 +1,209 @@
+"""
+Atomic credit and message-quota counters
+
+Each operation is a single Postgres statement behind a Supabase RPC (see
+quota_functions.sql), so concurrent messages from the same user can't lose
+increments or overspend credits. If the functions haven't been installed yet
+the service falls back to a compare-and-set update that retries on conflict.
+"""
+
+import os
+import atexit
+import threading
+from datetime import datetime
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+CREDIT_TYPES = ('image_credits', 'enhancement_credits', 'caption_credits')
+
+
+def _is_missing_function_error(error):
+    message = str(error)
+    return 'PGRST202' in message or 'Could not find the function' in message
+
+
+class QuotaService:
+    """Single round-trip check-and-decrement for credits and message counts"""
+
+    def __init__(self, client, max_retries=5):
+        self.client = client
+        self.max_retries = max_retries
+        self.rpc_available = True
+
+    def _rpc(self, name, params):
+        """Call a quota RPC; returns (called, data)"""
+        if not self.rpc_available:
+            return False, None
+        try:
+            return True, self.client.rpc(name, params).execute().data
+        except Exception as e:
+            if _is_missing_function_error(e):
+                logger.warning("⚠️ Quota RPC '%s' not installed - using conditional updates", name)
+                self.rpc_available = False
+            else:
+                logger.error("❌ Quota RPC '%s' failed: %s", name, e)
+            return False, None
+
+    def consume_credits(self, profile_id, credit_type, amount=1):
+        """Atomically take ``amount`` credits if available.
+
+        Returns the remaining balance, or None when there weren't enough.
+        """
+        if credit_type not in CREDIT_TYPES:
+            raise ValueError(f"Unknown credit type: {credit_type}")
+
+        called, remaining = self._rpc('consume_credits', {
+            'p_profile_id': profile_id,
+            'p_credit_type': credit_type,
+            'p_amount': amount
+        })
+        if called:
+            return remaining
+
+        # Fallback: compare-and-set on the current value, retried on conflict
+        for _ in range(self.max_retries):
+            response = self.client.table('user_credits').select('*').eq('profile_id', profile_id).execute()
+            if not response.data:
+                return None
+            credits = response.data[0]
+            current = credits.get(credit_type) or 0
+            if current < amount:
+                return None
+
+            updated = self.client.table('user_credits').update({
+                credit_type: current - amount,
+                'total_credits_used': (credits.get('total_credits_used') or 0) + amount,
+                'updated_at': datetime.now().isoformat()
+            }).eq('profile_id', profile_id).eq(credit_type, current).execute()
+            if updated.data:
+                return current - amount
+        logger.error("❌ Credit update kept conflicting for %s - %s", profile_id, credit_type)
+        return None
+
+    def increment_messages(self, profile_id, count=1):
+        """Atomically add ``count`` to profiles.used_messages; returns the new total"""
+        return self._increment_messages(profile_id, count)[0]
+
+    def _increment_messages(self, profile_id, count):
+        """Returns (new total, applied); applied is False only when the write failed"""
+        called, used = self._rpc('increment_used_messages', {
+            'p_profile_id': profile_id,
+            'p_count': count
+        })
+        if called:
+            return used, True
+
+        for _ in range(self.max_retries):
+            response = self.client.table('profiles').select('used_messages').eq('id', profile_id).execute()
+            if not response.data:
+                # Profile is gone, nothing to retry
+                return None, True
+            current = response.data[0].get('used_messages')
+            query = self.client.table('profiles').update({'used_messages': (current or 0) + count}).eq('id', profile_id)
+            query = query.is_('used_messages', 'null') if current is None else query.eq('used_messages', current)
+            if query.execute().data:
+                return (current or 0) + count, True
+        logger.error("❌ Message usage update kept conflicting for %s", profile_id)
+        return None, False
+
+    def increment_messages_batch(self, deltas):
+        """Apply many {profile_id: count} increments, in one call when possible.
+
+        Returns the {profile_id: count} increments that were not applied.
+        """
+        if not deltas:
+            return {}
+        profile_ids = list(deltas.keys())
+        called, _ = self._rpc('increment_used_messages_batch', {
+            'p_profile_ids': profile_ids,
+            'p_counts': [deltas[pid] for pid in profile_ids]
+        })
+        if called:
+            return {}
+        failed = {}
+        for profile_id in profile_ids:
+            try:
+                applied = self._increment_messages(profile_id, deltas[profile_id])[1]
+            except Exception as e:
+                logger.error("❌ Message usage update failed for %s: %s", profile_id, e)
+                applied = False
+            if not applied:
+                failed[profile_id] = deltas[profile_id]
+        return failed
+
+    def reset_monthly_image_credits(self, credits_by_plan):
+        """Reset image credits for all active subscribers in one statement.
+
+        Returns the number of rows updated, or None if the RPC isn't installed.
+        """
+        called, updated = self._rpc('reset_monthly_image_credits', {'p_credits': credits_by_plan})
+        return updated if called else None
+
+
+class UsageAccumulator:
+    """Optional write-behind buffer for message usage.
+
+    Deltas are summed in-process and flushed every ``flush_interval`` seconds
+    (and at exit) as one batched increment. Readers add pending() to the
+    stored count so limits stay exact inside this worker.
+    """
+
+    def __init__(self, quota_service, flush_interval=5.0, on_flush=None):
+        self.quota_service = quota_service
+        self.flush_interval = flush_interval
+        self.on_flush = on_flush
+        self._deltas = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="usage-flush")
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def add(self, profile_id, count=1):
+        with self._lock:
+            self._deltas[profile_id] = self._deltas.get(profile_id, 0) + count
+
+    def pending(self, profile_id):
+        with self._lock:
+            return self._deltas.get(profile_id, 0)
+
+    def flush(self):
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        if not deltas:
+            return
+        try:
+            failed = self.quota_service.increment_messages_batch(deltas)
+        except Exception as e:
+            logger.error("❌ Usage flush failed, will retry: %s", e)
+            failed = deltas
+        if failed:
+            # Put back only what wasn't written, so a retry never counts twice
+            with self._lock:
+                for profile_id, count in failed.items():
+                    self._deltas[profile_id] = self._deltas.get(profile_id, 0) + count
+
+        applied = {profile_id: count for profile_id, count in deltas.items() if profile_id not in failed}
+        if applied and self.on_flush:
+            try:
+                self.on_flush(applied)
+            except Exception as e:
+                logger.warning("⚠️ Usage flush callback failed: %s", e)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        self._stop.set()
+        self.flush()
+
+
+def create_usage_accumulator(quota_service, on_flush=None):
+    """Build the write-behind accumulator if QUOTA_WRITE_BEHIND is enabled"""
+    if os.getenv("QUOTA_WRITE_BEHIND", "false").lower() not in ('1', 'true', 'yes'):
+        return None
+    interval = float(os.getenv("QUOTA_FLUSH_INTERVAL", "5"))
+    logger.info("✅ Message usage write-behind enabled (flush every %ss)", interval)
+    return UsageAccumulator(quota_service, flush_interval=interval, on_flush=on_flush)
@@ -0,0 +1,73 @@
+-- Atomic quota functions used by quota.py
+-- Run once in the Supabase SQL editor. Until they exist the app falls back
+-- to compare-and-set updates.
+
+-- Take p_amount credits only if the balance allows it.
+-- Returns the remaining balance, or NULL when there weren't enough credits.
+create or replace function consume_credits(p_profile_id uuid, p_credit_type text, p_amount integer default 1)
+returns integer
+language plpgsql
+as $$
+declare
+    remaining integer;
+begin
+    if p_credit_type not in ('image_credits', 'enhancement_credits', 'caption_credits') then
+        raise exception 'Unknown credit type: %', p_credit_type;
+    end if;
+
+    execute format(
+        'update user_credits
+            set %1$I = %1$I - $1,
+                total_credits_used = coalesce(total_credits_used, 0) + $1,
+                updated_at = now()
+          where profile_id = $2 and %1$I >= $1
+      returning %1$I',
+        p_credit_type
+    )
+    into remaining
+    using p_amount, p_profile_id;
+
+    return remaining;
+end;
+$$;
+
+-- Add to profiles.used_messages and return the new total.
+create or replace function increment_used_messages(p_profile_id uuid, p_count integer default 1)
+returns integer
+language sql
+as $$
+    update profiles
+       set used_messages = coalesce(used_messages, 0) + p_count
+     where id = p_profile_id
+ returning used_messages;
+$$;
+
+-- Apply many increments in one statement (write-behind flushes).
+create or replace function increment_used_messages_batch(p_profile_ids uuid[], p_counts integer[])
+returns void
+language sql
+as $$
+    update profiles p
+       set used_messages = coalesce(p.used_messages, 0) + d.cnt
+      from unnest(p_profile_ids, p_counts) as d(id, cnt)
+     where p.id = d.id;
+$$;
+
+-- Monthly reset: set image credits for every active subscriber in one
+-- statement. p_credits maps plan_type -> credits; unknown plans get 'basic'.
+-- Returns the number of credit rows updated.
+create or replace function reset_monthly_image_credits(p_credits jsonb)
+returns integer
+language sql
+as $$
+    with updated as (
+        update user_credits uc
+           set image_credits = coalesce((p_credits ->> s.plan_type)::integer, (p_credits ->> 'basic')::integer),
+               updated_at = now()
+          from subscriptions s
+         where s.profile_id = uc.profile_id
+           and s.is_active
+     returning uc.profile_id
+    )
+    select count(*)::integer from updated;
+$$;
@@ -0,0 +1,235 @@
+"""
+Cluster-aware job scheduler
+
+One loop thread per process computes the next due job with the `schedule`
+library and sleeps exactly until then (no hourly polling). Due jobs are
+handed to a small executor pool so a long job never delays the others, and
+a job that is still running is not started again.
+
+Cluster jobs (cron-like maintenance) must run once per deployment, not once
+per gunicorn worker. Before running, the worker takes a lease:
+
+    1. The acquire_scheduler_lease RPC (scheduler_functions.sql) - a row per
+       job in scheduler_leases, so only one process in the cluster wins.
+    2. If the RPC isn't installed, a per-host file lock elects one leader
+       process on this machine.
+
+The lease row records when the job last ran, and a worker only wins it
+once min_interval has passed since then. Every worker keeps its own timer,
+so for interval jobs min_interval defaults to the full interval less a
+small skew margin: whichever worker fires first in an interval runs the job,
+the rest find it ran recently. Local jobs (per-process caches) skip the
+lease.
+
+Settings (env):
+    SCHEDULER_ENABLED    set to false to run no jobs in this process (default true)
+    SCHEDULER_WORKERS    executor threads (default 4)
+    SCHEDULER_LOCK_FILE  leader lock for the file fallback
+    SCHEDULER_LEASE_SKEW seconds an interval job may start early on another worker (default 30)
+"""
+
+import os
+import time
+import socket
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import schedule
+from app_logging import get_logger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = get_logger(__name__)
+
+DAY_NAMES = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+LEASE_SKEW_SECONDS = int(os.getenv("SCHEDULER_LEASE_SKEW", "30"))
+
+
+def _is_missing_function_error(error):
+    message = str(error)
+    return 'PGRST202' in message or 'Could not find the function' in message
+
+
+class ClusterScheduler:
+    """Precise, pooled scheduler with per-job leases and metrics"""
+
+    def __init__(self, client=None, workers=4, max_sleep=300, lock_file=None, enabled=True):
+        self.client = client
+        self.enabled = enabled
+        self.max_sleep = max_sleep
+        self.lock_file = lock_file or os.path.join('/tmp', 'jengabi-scheduler.lock')
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.rpc_available = client is not None
+        self._scheduler = schedule.Scheduler()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scheduler-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._leader_file = None
+
+    # ----- registration -----
+
+    def _register(self, name, func, cluster, min_interval, builders):
+        self._jobs[name] = {
+            'func': func,
+            'cluster': cluster,
+            'min_interval': min_interval,
+            'running': False,
+            'metrics': {'runs': 0, 'failures': 0, 'skipped': 0, 'last_started': None,
+                        'last_duration': None, 'last_error': None, 'total_seconds': 0.0},
+            'schedule_jobs': [builder(self._scheduler).do(self._dispatch, name) for builder in builders]
+        }
+        self._wake.set()
+
+    def every_seconds(self, name, seconds, func, cluster=False, min_interval=None):
+        """Run ``func`` every ``seconds``"""
+        if min_interval is None:
+            min_interval = max(1, seconds - min(LEASE_SKEW_SECONDS, seconds // 10))
+        self._register(name, func, cluster, min_interval, [lambda s: s.every(seconds).seconds])
+
+    def daily_at(self, name, at, func, cluster=True, min_interval=3600):
+        """Run ``func`` every day at ``at`` (HH:MM, local time)"""
+        self._register(name, func, cluster, min_interval, [lambda s: s.every().day.at(at)])
+
+    def weekly_at(self, name, days, at, func, cluster=True, min_interval=3600):
+        """Run ``func`` at ``at`` on each of ``days`` ('sunday', ...)"""
+        for day in days:
+            if day not in DAY_NAMES:
+                raise ValueError(f"Unknown day: {day}")
+        self._register(name, func, cluster, min_interval,
+                       [lambda s, day=day: getattr(s.every(), day).at(at) for day in days])
+
+    # ----- leases -----
+
+    def _acquire_file_leader(self):
+        if fcntl is None:
+            return True
+        if self._leader_file is None:
+            handle = open(self.lock_file, 'a+')
+            try:
+                fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                handle.close()
+                return False
+            # Held for the life of the process
+            self._leader_file = handle
+            logger.info("✅ Scheduler: %s is the leader on this host", self.holder)
+        return True
+
+    def acquire_lease(self, name, min_interval):
+        """True if this process may run cluster job ``name`` now (no run in the last ``min_interval`` seconds)"""
+        if self.rpc_available:
+            try:
+                result = self.client.rpc('acquire_scheduler_lease', {
+                    'p_job_name': name,
+                    'p_holder': self.holder,
+                    'p_min_interval_seconds': int(min_interval)
+                }).execute()
+                return bool(result.data)
+            except Exception as e:
+                if _is_missing_function_error(e):
+                    logger.warning("⚠️ Scheduler lease RPC not installed - using a per-host leader lock")
+                    self.rpc_available = False
+                else:
+                    logger.error("❌ Scheduler lease error for %s: %s", name, e)
+                    return False
+        return self._acquire_file_leader()
+
+    # ----- execution -----
+
+    def _dispatch(self, name):
+        job = self._jobs[name]
+        with self._lock:
+            if job['running']:
+                job['metrics']['skipped'] += 1
+                logger.warning("⚠️ Scheduler: %s is still running - skipping this run", name)
+                return
+            job['running'] = True
+        self._executor.submit(self._run, name)
+
+    def _run(self, name):
+        job = self._jobs[name]
+        metrics = job['metrics']
+        try:
+            if job['cluster'] and not self.acquire_lease(name, job['min_interval']):
+                with self._lock:
+                    metrics['skipped'] += 1
+                return
+            started = time.time()
+            metrics['last_started'] = datetime.now().isoformat()
+            try:
+                job['func']()
+                metrics['last_error'] = None
+            except Exception as e:
+                metrics['failures'] += 1
+                metrics['last_error'] = str(e)
+                logger.error("❌ Scheduled job %s failed: %s", name, e)
+            duration = time.time() - started
+            with self._lock:
+                metrics['runs'] += 1
+                metrics['last_duration'] = round(duration, 2)
+                metrics['total_seconds'] += duration
+        finally:
+            with self._lock:
+                job['running'] = False
+
+    def run_now(self, name):
+        """Run a registered job immediately (still subject to its lease)"""
+        self._dispatch(name)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._scheduler.run_pending()
+            idle = self._scheduler.idle_seconds
+            timeout = self.max_sleep if idle is None else min(max(idle, 0.0), self.max_sleep)
+            # Wakes early when a job is registered or the scheduler stops
+            self._wake.wait(timeout)
+            self._wake.clear()
+
+    def start(self):
+        if not self.enabled:
+            logger.warning("⚠️ Scheduler disabled in this process")
+            return
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True, name="scheduler")
+            self._thread.start()
+            logger.info("✅ Scheduler started with %s jobs (%s)", len(self._jobs), self.holder)
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self._executor.shutdown(wait=False)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'holder': self.holder,
+                'lease_backend': 'database' if self.rpc_available else 'host_lock',
+                'jobs': {
+                    name: {
+                        **job['metrics'],
+                        'total_seconds': round(job['metrics']['total_seconds'], 2),
+                        'running': job['running'],
+                        'cluster': job['cluster'],
+                        'next_run': min((j.next_run.isoformat() for j in job['schedule_jobs'] if j.next_run), default=None)
+                    }
+                    for name, job in self._jobs.items()
+                }
+            }
+
+
+def create_scheduler(client):
+    """Build the process scheduler from env settings"""
+    return ClusterScheduler(
+        client,
+        workers=int(os.getenv("SCHEDULER_WORKERS", "4")),
+        lock_file=os.getenv("SCHEDULER_LOCK_FILE"),
+        enabled=os.getenv("SCHEDULER_ENABLED", "true").lower() in ('1', 'true', 'yes')
+    )
@@ -0,0 +1,28 @@
+-- Cluster-wide job leases used by scheduler.py
+-- Run once in the Supabase SQL editor. Until they exist each host elects a
+-- leader process with a local file lock instead.
+
+create table if not exists scheduler_leases (
+    job_name    text primary key,
+    holder      text not null,
+    last_run_at timestamptz not null
+);
+-- Earlier versions kept a fixed-TTL expires_at instead
+alter table scheduler_leases add column if not exists last_run_at timestamptz not null default 'epoch';
+alter table scheduler_leases drop column if exists expires_at;
+drop function if exists acquire_scheduler_lease(text, text, integer);
+
+-- Claim a run of p_job_name if it has not run anywhere in the last
+-- p_min_interval_seconds. Returns true when the caller should run it.
+create or replace function acquire_scheduler_lease(p_job_name text, p_holder text, p_min_interval_seconds integer)
+returns boolean
+language sql
+as $$
+    insert into scheduler_leases as l (job_name, holder, last_run_at)
+    values (p_job_name, p_holder, now())
+    on conflict (job_name) do update
+        set holder = excluded.holder,
+            last_run_at = excluded.last_run_at
+      where l.last_run_at <= now() - make_interval(secs => p_min_interval_seconds)
+    returning true;
+$$;
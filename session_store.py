@@ -0,0 +1,334 @@
+"""
+Conversation session storage
+
+Sessions hold the per-user conversation state (onboarding step, continue_data,
+mpesa_subscription_flow, uploaded_image_url, ...). The store is picked with
+SESSION_STORE_URL:
+
+    memory://                 in-process LRU (default, single worker only)
+    sqlite:///path/to/file    shared by every worker on one host (WAL mode)
+    redis://host:6379/0       shared by every worker on every node
+
+Handlers keep mutating plain dicts. A request checks sessions out with
+checkout(), and commit() writes back only the top-level keys that changed,
+inside an atomic per-key update, so two workers touching different fields of
+the same session don't overwrite each other.
+"""
+
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+# Sessions larger than this are zlib-compressed before storing
+COMPRESS_THRESHOLD = 512
+_MISSING = object()
+
+
+def serialize_session(session):
+    """Encode a session compactly: tagged JSON, compressed when large"""
+    raw = json.dumps(session, separators=(',', ':'), default=str).encode('utf-8')
+    if len(raw) > COMPRESS_THRESHOLD:
+        return b'z' + zlib.compress(raw)
+    return b'j' + raw
+
+
+def deserialize_session(blob):
+    """Decode a value written by serialize_session()"""
+    if not blob:
+        return None
+    if isinstance(blob, str):
+        blob = blob.encode('utf-8')
+    tag, body = blob[:1], blob[1:]
+    if tag == b'z':
+        body = zlib.decompress(body)
+    return json.loads(body.decode('utf-8'))
+
+
+class SessionStore:
+    """Base class - backends implement get/set/delete/keys/update"""
+
+    shared = True
+
+    def __init__(self, ttl_seconds=86400):
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+
+    # ----- backend interface -----
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, session):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def keys(self):
+        raise NotImplementedError
+
+    def update(self, key, func):
+        """Atomically apply ``func(session) -> session`` to one key"""
+        raise NotImplementedError
+
+    def exists(self, key):
+        return self.get(key) is not None
+
+    def purge_expired(self):
+        """Drop expired sessions; returns how many were removed"""
+        return 0
+
+    # ----- request working set -----
+
+    def _working_set(self):
+        working = getattr(self._local, 'working', None)
+        if working is None:
+            working = self._local.working = {}
+        return working
+
+    def checkout(self, key):
+        """Return the session for ``key``, the same dict for the whole request"""
+        working = self._working_set()
+        if key in working:
+            return working[key][0]
+
+        session = self.get(key) or {}
+        snapshot = serialize_session(session)
+        working[key] = (session, snapshot, deserialize_session(snapshot))
+        return session
+
+    def commit(self):
+        """Write back every session changed during this request"""
+        working = getattr(self._local, 'working', None)
+        self._local.working = None
+        if not working:
+            return
+
+        for key, (session, snapshot, original) in working.items():
+            if serialize_session(session) == snapshot:
+                continue
+
+            changed = {k: v for k, v in session.items() if original.get(k, _MISSING) != v}
+            removed = [k for k in original if k not in session]
+
+            def merge(current, changed=changed, removed=removed):
+                current = current or {}
+                for k in removed:
+                    current.pop(k, None)
+                current.update(changed)
+                return current
+
+            try:
+                self.update(key, merge)
+            except Exception as e:
+                logger.error("❌ Session commit failed for %s: %s", key, e)
+
+
+class MemorySessionStore(SessionStore):
+    """In-process LRU store with TTL expiry - sessions are live dicts"""
+
+    shared = False
+
+    def __init__(self, ttl_seconds=86400, max_entries=10000):
+        super().__init__(ttl_seconds)
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def _expired(self, touched_at, now):
+        return self.ttl_seconds and now - touched_at > self.ttl_seconds
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            session, touched_at = entry
+            if self._expired(touched_at, now):
+                del self._data[key]
+                return None
+            self._data[key] = (session, now)
+            self._data.move_to_end(key)
+            return session
+
+    def set(self, key, session):
+        with self._lock:
+            self._data[key] = (session, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def update(self, key, func):
+        with self._lock:
+            session = func(self.get(key))
+            self.set(key, session)
+            return session
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [k for k, (_, touched_at) in self._data.items() if self._expired(touched_at, now)]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+    def checkout(self, key):
+        # Live dicts are already shared by every thread in this process
+        session = self.get(key)
+        if session is None:
+            session = {}
+            self.set(key, session)
+        return session
+
+    def commit(self):
+        pass
+
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite store in WAL mode, shared by all workers on one host"""
+
+    def __init__(self, path, ttl_seconds=86400):
+        super().__init__(ttl_seconds)
+        self.path = path
+        self._conn_local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                "key TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)")
+
+    def _connection(self):
+        conn = getattr(self._conn_local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn_local.conn = conn
+        return conn
+
+    def _expires_at(self):
+        return time.time() + (self.ttl_seconds or 10 * 365 * 86400)
+
+    def get(self, key):
+        row = self._connection().execute(
+            "SELECT data FROM sessions WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return deserialize_session(row[0]) if row else None
+
+    def set(self, key, session):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO sessions (key, data, expires_at) VALUES (?, ?, ?)",
+            (key, serialize_session(session), self._expires_at())
+        )
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM sessions WHERE key = ?", (key,))
+
+    def keys(self):
+        rows = self._connection().execute(
+            "SELECT key FROM sessions WHERE expires_at > ?", (time.time(),)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def update(self, key, func):
+        conn = self._connection()
+        # BEGIN IMMEDIATE takes the write lock up front so read-modify-write is atomic
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            session = func(self.get(key))
+            self.set(key, session)
+            conn.execute("COMMIT")
+            return session
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def purge_expired(self):
+        cursor = self._connection().execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+        return cursor.rowcount
+
+
+class RedisSessionStore(SessionStore):
+    """Redis-protocol store shared across nodes; TTL handled by the server"""
+
+    def __init__(self, url, ttl_seconds=86400, prefix="jengabi:session:"):
+        super().__init__(ttl_seconds)
+        import redis
+        self._redis = redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f"{self.prefix}{key}"
+
+    def get(self, key):
+        return deserialize_session(self.client.get(self._key(key)))
+
+    def set(self, key, session):
+        self.client.set(self._key(key), serialize_session(session), ex=self.ttl_seconds or None)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def keys(self):
+        start = len(self.prefix)
+        return [k.decode('utf-8')[start:] for k in self.client.scan_iter(match=f"{self.prefix}*", count=500)]
+
+    def update(self, key, func, max_retries=10):
+        redis_key = self._key(key)
+        for _ in range(max_retries):
+            with self.client.pipeline() as pipe:
+                try:
+                    # WATCH/MULTI: retried if another worker wrote the key meanwhile
+                    pipe.watch(redis_key)
+                    session = func(deserialize_session(pipe.get(redis_key)))
+                    pipe.multi()
+                    pipe.set(redis_key, serialize_session(session), ex=self.ttl_seconds or None)
+                    pipe.execute()
+                    return session
+                except self._redis.WatchError:
+                    continue
+        raise RuntimeError(f"Session update for {key} kept conflicting")
+
+
+def create_session_store(url=None, ttl_seconds=None):
+    """Build a store from a URL like the limiter's storage_uri"""
+    url = url or os.getenv("SESSION_STORE_URL", "memory://")
+    ttl_seconds = ttl_seconds if ttl_seconds is not None else int(os.getenv("SESSION_TTL_SECONDS", "86400"))
+
+    try:
+        if url.startswith("sqlite:///"):
+            store = SQLiteSessionStore(url[len("sqlite:///"):], ttl_seconds=ttl_seconds)
+        elif url.startswith(("redis://", "rediss://", "unix://")):
+            store = RedisSessionStore(url, ttl_seconds=ttl_seconds)
+        else:
+            store = MemorySessionStore(
+                ttl_seconds=ttl_seconds,
+                max_entries=int(os.getenv("SESSION_MAX_ENTRIES", "10000"))
+            )
+        logger.info("✅ Session store ready: %s", type(store).__name__)
+        return store
+    except Exception as e:
+        logger.error("❌ Session store '%s' unavailable, using memory: %s", url, e)
+        return MemorySessionStore(ttl_seconds=ttl_seconds)
+
+
+# Global instance
+session_store = create_session_store()
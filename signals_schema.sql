@@ -0,0 +1,46 @@
+-- Rolling activity windows used by business_signals.py
+-- Run once in the Supabase SQL editor before enabling the profile_signals job.
+
+create table if not exists profile_signals (
+    profile_id         uuid primary key references profiles(id) on delete cascade,
+    week_start         date not null,
+    activity           integer[] not null,
+    payments           integer[] not null,
+    observed_weeks     integer not null default 0,
+    growth_pattern     text not null default 'stable',
+    customer_pattern   text not null default 'growing_base',
+    updated_at         timestamptz not null default now()
+);
+
+-- Message usage, logged when it is written (SignalAggregator.record_messages)
+create table if not exists message_events (
+    id            bigint generated always as identity primary key,
+    profile_id    uuid not null references profiles(id) on delete cascade,
+    message_count integer not null,
+    created_at    timestamptz not null default now()
+);
+
+-- Last created_at folded in from each source table, plus the ids already
+-- folded inside the lookback window (id -> created_at)
+create table if not exists signal_watermarks (
+    source     text primary key,
+    last_seen  timestamptz not null,
+    recent_ids jsonb not null default '{}'
+);
+alter table signal_watermarks add column if not exists recent_ids jsonb not null default '{}';
+
+-- Message counts now come from message_events
+alter table profile_signals drop column if exists last_used_messages;
+
+-- Current classification, read straight off the cached profile.
+-- Defaults match the classifiers' "no data" answers.
+alter table profiles add column if not exists growth_pattern text not null default 'stable';
+alter table profiles add column if not exists customer_pattern text not null default 'growing_base';
+
+-- The aggregator reads every source past its watermark
+create index if not exists feature_usage_created_at_idx on feature_usage (created_at);
+create index if not exists mpesa_transactions_created_at_idx on mpesa_transactions (created_at);
+create index if not exists message_events_created_at_idx on message_events (created_at);
+
+-- Quiet profiles are found by the week their window was last rolled to
+create index if not exists profile_signals_week_start_idx on profile_signals (week_start);
@@ -0,0 +1,171 @@
+"""
+Progressive delivery of LLM output to Telegram
+
+A TelegramStreamWriter posts a placeholder message and keeps editing it with
+editMessageText as tokens arrive (throttled to stay inside Telegram's edit
+rate limits). When the text passes the 4000-char limit it rolls over into a
+new message. finish() swaps the streamed text for the handler's final,
+formatted reply.
+
+The writer for the current Telegram job is kept in a thread-local, so
+handlers just call stream_completion() and get streaming when a chat is
+listening, and a plain completion otherwise (web API, scheduled jobs).
+"""
+
+import os
+import time
+import threading
+
+from llm_gateway import llm_gateway
+from http_client import telegram_http
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+TELEGRAM_MAX_LENGTH = 4000
+STREAMING_ENABLED = os.getenv("TELEGRAM_STREAMING", "true").lower() in ('1', 'true', 'yes')
+
+_local = threading.local()
+
+
+def _cut_point(text, max_length):
+    """Where to break text that is longer than max_length"""
+    window = text[:max_length]
+    cut = window.rfind('\n\n')
+    if cut < max_length // 2:
+        cut = window.rfind('\n')
+    if cut < max_length // 2:
+        cut = window.rfind(' ')
+    return cut if cut > 0 else max_length
+
+
+def split_telegram_text(text, max_length=TELEGRAM_MAX_LENGTH):
+    """Split text into chunks that fit one message, breaking at paragraph/line/word boundaries"""
+    chunks = []
+    while len(text) > max_length:
+        cut = _cut_point(text, max_length)
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
+
+
+class TelegramStreamWriter:
+    """Streams text into one or more Telegram messages via throttled edits"""
+
+    def __init__(self, chat_id, api_url, max_length=TELEGRAM_MAX_LENGTH, min_interval=1.0,
+                 placeholder="⏳ Working on it...", http=None):
+        self.chat_id = chat_id
+        self.api_url = api_url
+        self.max_length = max_length
+        self.min_interval = min_interval
+        self.placeholder = placeholder
+        self.http = http or telegram_http
+        self.messages = []  # [message_id, last_text_sent]
+        self.text = ''
+        self.started = False
+        self._last_edit = 0.0
+
+    def _post(self, method, payload):
+        try:
+            response = self.http.post(f"{self.api_url}/{method}", json=payload)
+            if response.status_code == 200:
+                return response.json().get('result')
+            logger.warning("⚠️ Telegram %s failed: %s - %s", method, response.status_code, response.text)
+        except Exception as e:
+            logger.warning("⚠️ Telegram %s error: %s", method, e)
+        return None
+
+    def _send(self, text, parse_mode=None):
+        payload = {"chat_id": self.chat_id, "text": text}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        result = self._post("sendMessage", payload)
+        if result is None and parse_mode:
+            # Markdown rejected - fall back to plain text
+            result = self._post("sendMessage", {"chat_id": self.chat_id, "text": text})
+        if result:
+            self.messages.append([result['message_id'], text])
+        return result
+
+    def _edit(self, index, text, parse_mode=None):
+        message = self.messages[index]
+        if message[1] == text:
+            return
+        payload = {"chat_id": self.chat_id, "message_id": message[0], "text": text}
+        if parse_mode:
+            payload["parse_mode"] = parse_mode
+        result = self._post("editMessageText", payload)
+        if result is None and parse_mode:
+            self._post("editMessageText", {"chat_id": self.chat_id, "message_id": message[0], "text": text})
+        message[1] = text
+        self._last_edit = time.time()
+
+    def begin(self):
+        """Post the placeholder message"""
+        if not self.started:
+            self.started = True
+            self._send(self.placeholder)
+
+    def append(self, delta):
+        """Add streamed text, editing the current message at a throttled cadence"""
+        self.begin()
+        if not self.messages:
+            return
+        self.text += delta
+
+        # Roll over into a new message once the current one is full
+        while len(self.text) > self.max_length:
+            cut = _cut_point(self.text, self.max_length)
+            self._edit(-1, self.text[:cut].rstrip())
+            self.text = self.text[cut:].lstrip()
+            self._send('…')
+
+        if time.time() - self._last_edit >= self.min_interval and self.text.strip():
+            self._edit(-1, self.text + ' ▌')
+
+    def finish(self, final_text=None):
+        """Replace the streamed messages with the final reply (Markdown)"""
+        if not self.started:
+            return False
+        chunks = split_telegram_text(final_text or self.text or self.placeholder, self.max_length)
+        for i, chunk in enumerate(chunks):
+            if i < len(self.messages):
+                self._edit(i, chunk, parse_mode="Markdown")
+            else:
+                self._send(chunk, parse_mode="Markdown")
+        # Final reply is shorter than what was streamed - remove the leftovers
+        for message_id, _ in self.messages[len(chunks):]:
+            self._post("deleteMessage", {"chat_id": self.chat_id, "message_id": message_id})
+        del self.messages[len(chunks):]
+        return True
+
+
+def start_stream(chat_id, api_url, **kwargs):
+    """Attach a stream writer for ``chat_id`` to the current thread"""
+    writer = TelegramStreamWriter(chat_id, api_url, **kwargs) if STREAMING_ENABLED and api_url else None
+    _local.writer = writer
+    return writer
+
+
+def get_active_stream():
+    return getattr(_local, 'writer', None)
+
+
+def end_stream():
+    _local.writer = None
+
+
+def stream_completion(messages, model="gpt-4o-mini", max_tokens=None, temperature=None, **kwargs):
+    """Complete a prompt, streaming it to the active Telegram chat if there is one"""
+    writer = get_active_stream()
+    if writer is None:
+        return llm_gateway.complete(messages, model=model, max_tokens=max_tokens, temperature=temperature, **kwargs)
+
+    writer.begin()
+    parts = []
+    for delta in llm_gateway.stream(messages, model=model, max_tokens=max_tokens, temperature=temperature, **kwargs):
+        parts.append(delta)
+        writer.append(delta)
+    return ''.join(parts).strip()
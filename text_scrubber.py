@@ -0,0 +1,200 @@
+"""
+Precompiled, single-pass text sanitization and PII scrubbing
+
+Every inbound message and every 4wd/qstn payload is cleaned here. Instead
+of one re.sub per rule (and one str.replace per location), each rule set is
+compiled once into a single alternation of named groups and applied in one
+scan; the literal location list is compiled into a character trie so the
+regex engine walks shared prefixes once (the regex equivalent of
+Aho-Corasick).
+
+Overlapping matches resolve leftmost-first, then by rule order. The
+business-name rule is the exception: it is greedy and starts at the first
+word of a phrase, so inside the combined scan it would swallow names and
+emails that the old passes replaced first. It runs as a second precompiled
+pass over the result, as it always did, and only when the text contains a
+business indicator at all.
+
+Run ``python text_scrubber.py`` to check the output against the previous
+rule-by-rule implementation and micro-benchmark both.
+"""
+
+import re
+import time
+
+# Characters sanitize_input() has always stripped. After removing them,
+# html.escape() has nothing left to escape, so one translate() covers both.
+_DANGEROUS_CHARS = str.maketrans('', '', '<>&"\';(){}[]\\')
+MAX_MESSAGE_LENGTH = 1000
+
+# 'javascript' is covered by 'script' (the old pass turned it into java[BLOCKED])
+ATTACK_PATTERNS = [
+    r'script', r'onload', r'onerror', r'alert', r'document\.cookie',
+    r'window\.location', r'eval\s*\(', r'setTimeout\s*\(', r'exec\s*\('
+]
+
+SPECIFIC_LOCATIONS = [
+    'nairobi cbd', 'westlands', 'karen', 'mombasa road', 'thika road',
+    'langata', 'kileleshwa', 'lavington', 'kilimani', 'parklands',
+    'industrial area', 'upper hill', 'nyayo estate'
+]
+
+BUSINESS_INDICATORS = ['ltd', 'limited', 'company', 'enterprises', 'ventures']
+
+
+def literal_trie_pattern(words):
+    """Regex matching any of ``words``, factored into a prefix trie"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        ends = '' in node
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 and not ends else '(?:' + '|'.join(branches) + ')'
+        return body + '?' if ends else body
+
+    return build(trie)
+
+
+class TextScrubber:
+    """Applies an ordered list of (pattern, replacement) rules in one scan"""
+
+    def __init__(self, rules):
+        self.replacements = {}
+        parts = []
+        for index, (pattern, replacement) in enumerate(rules):
+            name = f"r{index}"
+            self.replacements[name] = replacement
+            parts.append(f"(?P<{name}>{pattern})")
+        self.regex = re.compile('|'.join(parts))
+
+    def _replace(self, match):
+        return self.replacements[match.lastgroup]
+
+    def scrub(self, text):
+        return self.regex.sub(self._replace, text)
+
+
+attack_scrubber = TextScrubber([('(?i:' + '|'.join(ATTACK_PATTERNS) + ')', '[BLOCKED]')])
+
+PII_RULES = [
+    # Phone numbers
+    (r'\+\d{1,3}[-.\s]?\d{1,14}', '[PHONE]'),
+    (r'\d{10,}', '[NUMBER]'),
+    # Specific location references
+    (literal_trie_pattern(SPECIFIC_LOCATIONS), '[LOCATION]'),
+    # Exact monetary amounts
+    (r'KES\s?\d{1,3}(?:,\d{3})*(?:\.\d{2})?', '[AMOUNT]'),
+    (r'\d{1,3}(?:,\d{3})*\s?(?:shillings|bob)', '[AMOUNT]'),
+    (r'\$\s?\d{1,3}(?:,\d{3})*(?:\.\d{2})?', '[AMOUNT]'),
+    # Names (simple pattern)
+    (r'\b[A-Z][a-z]+ [A-Z][a-z]+\b', '[NAME]'),
+    # Email addresses
+    (r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', '[EMAIL]'),
+]
+
+# Business names (common Kenyan business patterns), applied after PII_RULES
+BUSINESS_RULE = (r'(?i:\b[\w\s]+(?:' + '|'.join(BUSINESS_INDICATORS) + r')\b)', '[BUSINESS]')
+
+pii_scrubber = TextScrubber(PII_RULES)
+business_scrubber = TextScrubber([BUSINESS_RULE])
+# The business rule backtracks at every word, so skip it for texts without an indicator
+_BUSINESS_HINT = re.compile('(?i:' + '|'.join(BUSINESS_INDICATORS) + ')')
+
+
+def strip_dangerous(text):
+    """Remove potentially dangerous characters, cap the length and trim"""
+    if not text or not isinstance(text, str):
+        return ""
+    return text.translate(_DANGEROUS_CHARS)[:MAX_MESSAGE_LENGTH].strip()
+
+
+def sanitize_message(text):
+    """strip_dangerous() plus blocking of script/attack keywords"""
+    return attack_scrubber.scrub(strip_dangerous(text))
+
+
+def scrub_pii(text):
+    """Replace phone numbers, locations, amounts, names, emails and business names"""
+    if not text:
+        return ""
+    text = pii_scrubber.scrub(text)
+    if _BUSINESS_HINT.search(text):
+        text = business_scrubber.scrub(text)
+    return text.strip()
+
+
+def _legacy_sanitize(text):
+    """sanitize_user_message() before the single-pass scrubbers"""
+    import html
+    cleaned = html.escape(re.sub(r'[<>&\"\';(){}\[\]\\]', '', text))[:MAX_MESSAGE_LENGTH].strip()
+    for pattern in [r'(?i)script', r'(?i)javascript', r'(?i)onload', r'(?i)onerror',
+                    r'(?i)alert', r'(?i)document\.cookie', r'(?i)window\.location',
+                    r'(?i)eval\s*\(', r'(?i)setTimeout\s*\(', r'(?i)exec\s*\(']:
+        if re.search(pattern, cleaned):
+            cleaned = re.sub(pattern, '[BLOCKED]', cleaned)
+    return cleaned
+
+
+def _legacy_pii(text):
+    """remove_sensitive_terms() before the single-pass scrubbers"""
+    text = re.sub(r'\+\d{1,3}[-.\s]?\d{1,14}', '[PHONE]', text)
+    text = re.sub(r'\d{10,}', '[NUMBER]', text)
+    for location in SPECIFIC_LOCATIONS:
+        text = text.replace(location, '[LOCATION]')
+    text = re.sub(r'KES\s?\d{1,3}(?:,\d{3})*(?:\.\d{2})?', '[AMOUNT]', text)
+    text = re.sub(r'\d{1,3}(?:,\d{3})*\s?(?:shillings|bob)', '[AMOUNT]', text)
+    text = re.sub(r'\$\s?\d{1,3}(?:,\d{3})*(?:\.\d{2})?', '[AMOUNT]', text)
+    text = re.sub(r'\b[A-Z][a-z]+ [A-Z][a-z]+\b', '[NAME]', text)
+    text = re.sub(r'\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Z|a-z]{2,}\b', '[EMAIL]', text)
+    text = re.sub(r'\b[\w\s]+(?:' + '|'.join(BUSINESS_INDICATORS) + r')\b', '[BUSINESS]', text, flags=re.IGNORECASE)
+    return text.strip()
+
+
+SAMPLES = [
+    "Hi, do you have the red dress in size 12? I can pick it up from westlands tomorrow",
+    "Please call me on +254712345678 or email buyer@example.com about the order",
+    "I paid KES 2,500 yesterday but the delivery to kilimani never came",
+    "<script>alert('x')</script> javascript:window.location='http://evil'",
+    "We need 50 crates for our hotel on mombasa road, how much per crate?",
+    "Mama Mboga Enterprises sells sukuma at 50 shillings a bunch",
+    # Business names next to people, emails and places
+    "I met Peter Otieno at Upper Hill Ltd",
+    "john@x.com from Jane Doe Ventures",
+    "Kiptoo ltd and Westlands Limited",
+]
+
+
+def _check_equivalence():
+    """Fail loudly if the scrubbers disagree with the legacy passes on SAMPLES"""
+    for legacy, current in ((_legacy_sanitize, sanitize_message), (_legacy_pii, scrub_pii)):
+        for sample in SAMPLES:
+            expected, actual = legacy(sample), current(sample)
+            assert expected == actual, f"{current.__name__}({sample!r}): {actual!r} != legacy {expected!r}"
+    print(f"identical output to the legacy passes on {len(SAMPLES)} samples")
+
+
+def _benchmark(iterations=20000):
+    """Compare against the previous rule-by-rule implementation"""
+    def run(func):
+        started = time.perf_counter()
+        for i in range(iterations):
+            func(SAMPLES[i % len(SAMPLES)])
+        return (time.perf_counter() - started) / iterations * 1e6
+
+    for label, legacy, current in (("sanitize_user_message", _legacy_sanitize, sanitize_message),
+                                   ("remove_sensitive_terms", _legacy_pii, scrub_pii)):
+        old_us, new_us = run(legacy), run(current)
+        print(f"{label:24s} legacy {old_us:7.2f} us  single-pass {new_us:7.2f} us  "
+              f"speedup {old_us / new_us:4.1f}x")
+
+
+if __name__ == '__main__':
+    _check_equivalence()
+    _benchmark()
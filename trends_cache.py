@@ -0,0 +1,162 @@
+"""
+Stale-while-revalidate cache for Google Trends results
+
+Keys are (keyword tuple, geo, timeframe). Business types map onto a small
+fixed set of keyword lists, and free-text business locations map onto a
+country code with normalize_geo(), so a handful of entries serve every user:
+
+    age < fresh_ttl              served from cache
+    fresh_ttl <= age < stale_ttl served from cache, refreshed in the background
+    older / missing              fetched now; concurrent callers share the fetch
+
+Failed fetches are remembered for error_ttl so a throttled API isn't
+hammered, and an old value is kept over a failed refresh.
+
+Settings (env):
+    TRENDS_FRESH_TTL  seconds a result is fresh (default 21600)
+    TRENDS_STALE_TTL  seconds a result may be served stale (default 86400)
+    TRENDS_ERROR_TTL  seconds to back off after a failed fetch (default 300)
+    TRENDS_GEO        country code for locations we can't place (default KE)
+"""
+
+import os
+import re
+import time
+import threading
+from app_logging import get_logger
+
+logger = get_logger(__name__)
+
+# Trends geo code -> the country name trending_searches() expects
+TRENDS_COUNTRIES = {
+    'KE': 'kenya', 'UG': 'uganda', 'TZ': 'tanzania', 'RW': 'rwanda',
+    'NG': 'nigeria', 'GH': 'ghana', 'ZA': 'south_africa'
+}
+
+GEO_ALIASES = {
+    'KE': ['kenya', 'nairobi', 'mombasa', 'kisumu', 'nakuru', 'eldoret', 'thika', 'naivasha',
+           'nyeri', 'kakamega', 'kitui', 'machakos', 'meru'],
+    'UG': ['uganda', 'kampala', 'entebbe'],
+    'TZ': ['tanzania', 'dar es salaam', 'arusha', 'dodoma'],
+    'RW': ['rwanda', 'kigali'],
+    'NG': ['nigeria', 'lagos', 'abuja'],
+    'GH': ['ghana', 'accra', 'kumasi'],
+    'ZA': ['south africa', 'johannesburg', 'cape town', 'durban'],
+}
+_GEO_BY_ALIAS = {alias: geo for geo, aliases in GEO_ALIASES.items() for alias in aliases}
+_GEO_RE = re.compile(r'\b(' + '|'.join(sorted(map(re.escape, _GEO_BY_ALIAS), key=len, reverse=True)) + r')\b')
+
+DEFAULT_GEO = os.getenv("TRENDS_GEO", "KE").upper()
+
+
+def normalize_geo(location):
+    """Country code for a free-text business location ('Nairobi CBD' -> 'KE')"""
+    text = (location or '').strip()
+    if text.upper() in TRENDS_COUNTRIES:
+        return text.upper()
+    match = _GEO_RE.search(text.lower())
+    return _GEO_BY_ALIAS[match.group(1)] if match else DEFAULT_GEO
+
+
+class TrendsCache:
+    """Per-key cache with background revalidation and single-flight fetches"""
+
+    def __init__(self, fresh_ttl=21600, stale_ttl=86400, error_ttl=300):
+        self.fresh_ttl = fresh_ttl
+        self.stale_ttl = stale_ttl
+        self.error_ttl = error_ttl
+        self._entries = {}   # key -> {'value', 'fetched_at', 'failed_at'}
+        self._inflight = {}  # key -> threading.Event
+        self._lock = threading.Lock()
+        self.stats = {'fresh_hits': 0, 'stale_hits': 0, 'misses': 0, 'refreshes': 0, 'errors': 0}
+
+    @staticmethod
+    def make_key(keywords, geo, timeframe):
+        return (tuple(keywords), geo, timeframe)
+
+    def _fetch(self, key, loader):
+        """Run ``loader`` for ``key`` unless a fetch is already in flight; returns the cached value"""
+        with self._lock:
+            event = self._inflight.get(key)
+            leader = event is None
+            if leader:
+                event = self._inflight[key] = threading.Event()
+
+        if leader:
+            try:
+                value = loader()
+                with self._lock:
+                    self.stats['refreshes'] += 1
+                    if value is None:
+                        raise ValueError("no data")
+                    self._entries[key] = {'value': value, 'fetched_at': time.time(), 'failed_at': None}
+            except Exception as e:
+                logger.warning("⚠️ Trends fetch failed for %s: %s", key[0], e)
+                with self._lock:
+                    self.stats['errors'] += 1
+                    entry = self._entries.setdefault(key, {'value': None, 'fetched_at': 0.0, 'failed_at': None})
+                    entry['failed_at'] = time.time()
+            finally:
+                with self._lock:
+                    del self._inflight[key]
+                event.set()
+        else:
+            event.wait()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry['value'] if entry else None
+
+    def _refresh_in_background(self, key, loader):
+        thread = threading.Thread(target=self._fetch, args=(key, loader), daemon=True, name="trends-refresh")
+        thread.start()
+
+    def get(self, key, loader):
+        """Return the value for ``key`` (possibly stale), or None if none could be fetched"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            age = now - entry['fetched_at'] if entry and entry['value'] is not None else None
+            backing_off = bool(entry and entry['failed_at'] and now - entry['failed_at'] < self.error_ttl)
+            refreshing = key in self._inflight
+
+            if age is not None and age < self.fresh_ttl:
+                self.stats['fresh_hits'] += 1
+                return entry['value']
+            if age is not None and age < self.stale_ttl:
+                self.stats['stale_hits'] += 1
+                value = entry['value']
+                revalidate = not refreshing and not backing_off
+            else:
+                self.stats['misses'] += 1
+                if backing_off:
+                    return entry['value'] if age is not None else None
+                value = None
+
+        if value is not None:
+            if revalidate:
+                self._refresh_in_background(key, loader)
+            return value
+        return self._fetch(key, loader)
+
+    def refresh(self, key, loader):
+        """Fetch ``key`` now (used by the warmer)"""
+        return self._fetch(key, loader)
+
+    def get_stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                **self.stats,
+                'entries': len(self._entries),
+                'oldest_seconds': round(max((now - e['fetched_at'] for e in self._entries.values()
+                                             if e['value'] is not None), default=0.0))
+            }
+
+
+# Global instance
+trends_cache = TrendsCache(
+    fresh_ttl=int(os.getenv("TRENDS_FRESH_TTL", "21600")),
+    stale_ttl=int(os.getenv("TRENDS_STALE_TTL", "86400")),
+    error_ttl=int(os.getenv("TRENDS_ERROR_TTL", "300"))
+)